@@ -1,18 +1,40 @@
-import google_secrets
+import startup
 
-import json
-from six.moves.urllib.request import urlopen
+import hashlib
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
-from flask import Flask, request, jsonify
-from flask.globals import request_ctx
-from flask_cors import cross_origin, CORS
-from jose import jwt
-
-import database
-import requests
-
-from config import client_origin_url, auth0_audience, auth0_domain, port
+with startup.timed("import flask"):
+    from flask import Flask, Response, request, jsonify, make_response
+    from flask.globals import request_ctx
+    from flask_cors import cross_origin, CORS
+with startup.timed("import jose"):
+    from jose import jwt
+    from jose.exceptions import JWTError
+with startup.timed("import httpx"):
+    import http_client
+
+with startup.timed("import database"):
+    import database
+import google_secrets
+import json_provider
+import metrics
+import query_profiler
+import sweeper
+
+from config import (client_origin_url, auth0_audience, auth0_domain, auth0_base_url, port,
+                    jwks_cache_ttl, token_cache_size, userinfo_ttl,
+                    userinfo_sweep_interval, userinfo_sweep_batch,
+                    warm_up_on_start, cold_start_budget, max_batch_trips,
+                    trip_page_size, max_trip_page_size,
+                    userinfo_rate_per_minute, userinfo_burst, userinfo_max_wait,
+                    userinfo_governor_users, metrics_token)
+from jwks import JWKSKeyStore
+from cache import LRUCache
+from singleflight import SingleFlight
+from token_bucket import KeyedTokenBuckets
 
 if not (client_origin_url and auth0_audience and auth0_domain):
     raise NameError("The required environment variables are missing. Check README and config.py.")
@@ -23,8 +45,66 @@ if not (client_origin_url and auth0_audience and auth0_domain):
 ALGORITHMS = ["RS256"]
 
 APP = Flask(__name__)
+json_provider.init_app(APP)
+
+cors = CORS(APP, resources={r"/api/*": {"origins": client_origin_url}}, expose_headers=["ETag", "Server-Timing"])
+
+# Auth0 signing keys, cached in-process (see jwks.py)
+jwks = JWKSKeyStore(auth0_base_url + "/.well-known/jwks.json",
+                    default_ttl=jwks_cache_ttl)
+
+# Payloads of tokens that already passed verify_token, keyed by the
+# sha256 of the token. Entries expire at the token's "exp" claim.
+verified_tokens = LRUCache(maxsize=token_cache_size)
+
+# First tier of the userinfo cache (the second is the userinfo table),
+# see get_userinfo.
+userinfo_cache = LRUCache(maxsize=token_cache_size, ttl=userinfo_ttl)
+
+# Purge expired userinfo cache rows in the background
+sweeper.start(userinfo_sweep_interval, userinfo_sweep_batch)
+
+# Per-stage timing of every request (see metrics.py), reported in the
+# Server-Timing header and at /api/metrics
+@APP.before_request
+def start_timing():
+    request_ctx.metrics_token = metrics.start_request(request.endpoint)
+    request_ctx.query_profile_token = query_profiler.start_request(request.endpoint)
+
+
+@APP.after_request
+def finish_timing(response):
+    query_profiler.finish_request(getattr(request_ctx, "query_profile_token", None))
+    header = metrics.finish_request(getattr(request_ctx, "metrics_token", None),
+                                    request.method, response.status_code)
+    if header is not None:
+        response.headers["Server-Timing"] = header
+        response.headers["Timing-Allow-Origin"] = client_origin_url
+    return response
+
+
+# One database session per request (see database.session_scope),
+# committed before the response is sent. GET requests only read (apart
+# from single-statement writes), so they skip BEGIN/COMMIT altogether.
+@APP.before_request
+def begin_db_session():
+    database.begin_request_session(read_only=request.method in ("GET", "HEAD"))
+
+
+# Registered after finish_timing so it runs before it, and the commit is
+# part of the measured request
+@APP.after_request
+def commit_db_session(response):
+    # On a 500 the handler may have stopped halfway; teardown rolls back
+    if response.status_code < 500:
+        database.commit_request_session()
+    return response
+
+
+@APP.teardown_request
+def end_db_session(exception):
+    database.end_request_session()
 
-cors = CORS(APP, resources={r"/api/*": {"origins": client_origin_url}})
 
 # Error handler
 class AuthError(Exception):
@@ -44,7 +124,12 @@ def handle_auth_error(ex):
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    auth = request.headers.get("Authorization", None)
+    return parse_auth_header(request.headers.get("Authorization", None))
+
+
+def parse_auth_header(auth):
+    """Obtains the Access Token from an Authorization header value
+    """
     if not auth:
         raise AuthError({"code": "authorization_header_missing",
                          "description":
@@ -70,28 +155,15 @@ def get_token_auth_header():
     return token
 
 
-def requires_auth(f):
-    """Determines if the Access Token is valid
+def verify_token(token):
+    """Checks the Access Token signature and claims and returns its payload
     """
-
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = get_token_auth_header()
-        jsonurl = urlopen("https://" + auth0_domain + "/.well-known/jwks.json")
-        jwks = json.loads(jsonurl.read())
-        unverified_header = jwt.get_unverified_header(token)
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
-        if rsa_key:
-            try:
+    unverified_header = jwt.get_unverified_header(token)
+    with metrics.timed("jwks"):
+        rsa_key = jwks.get_key(unverified_header["kid"])
+    if rsa_key:
+        try:
+            with metrics.timed("jwt_decode"):
                 payload = jwt.decode(
                     token,
                     rsa_key,
@@ -99,47 +171,132 @@ def requires_auth(f):
                     audience=auth0_audience,
                     issuer="https://" + auth0_domain + "/"
                 )
-            except jwt.ExpiredSignatureError:
-                raise AuthError({"code": "token_expired",
-                                 "description": "token is expired"}, 401)
-            except jwt.JWTClaimsError:
-                raise AuthError({"code": "invalid_claims",
-                                 "description":
-                                     "incorrect claims,"
-                                     "please check the audience and issuer"}, 401)
-            except Exception:
-                raise AuthError({"code": "invalid_header",
-                                 "description":
-                                     "Unable to parse authentication"
-                                     " token."}, 401)
-
-            request_ctx.current_user = payload
-            # Also get the user info
-            request_ctx.user_info = get_userinfo(token)
-
-            return f(*args, **kwargs)
-        raise AuthError({"code": "invalid_header",
-                         "description": "Unable to find appropriate key"}, 401)
+        except jwt.ExpiredSignatureError:
+            raise AuthError({"code": "token_expired",
+                             "description": "token is expired"}, 401)
+        except jwt.JWTClaimsError:
+            raise AuthError({"code": "invalid_claims",
+                             "description":
+                                 "incorrect claims,"
+                                 "please check the audience and issuer"}, 401)
+        except Exception:
+            raise AuthError({"code": "invalid_header",
+                             "description":
+                                 "Unable to parse authentication"
+                                 " token."}, 401)
+        return payload
+    raise AuthError({"code": "invalid_header",
+                     "description": "Unable to find appropriate key"}, 401)
+
+
+def token_cache_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def requires_auth(f):
+    """Determines if the Access Token is valid
+    """
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = get_token_auth_header()
+        # The frontend sends the same token with every call, so we only
+        # do the RSA verification once per token and then remember the
+        # payload until the token's "exp".
+        token_key = token_cache_key(token)
+        payload = verified_tokens.get(token_key)
+        if payload is None:
+            payload = verify_token(token)
+            if "exp" in payload:
+                verified_tokens.set(token_key, payload, expires_at=payload["exp"])
+
+        request_ctx.current_user = payload
+        # Also get the user info, unless the token already has the email
+        email = email_claim(payload)
+        if email is not None:
+            request_ctx.user_info = {"email": email}
+        else:
+            request_ctx.user_info = get_userinfo(token, payload.get("exp"))
+
+        return f(*args, **kwargs)
 
     return decorated
 
+def email_claim(payload):
+    """Returns the email in an access token's claims, if any. Access
+    tokens only carry it if an Auth0 Action adds it, usually under a
+    namespaced claim such as "https://<namespace>/email".
+    """
+    email = payload.get("email")
+    if isinstance(email, str) and email:
+        return email
+    for claim, value in payload.items():
+        if claim.endswith("/email") and isinstance(value, str) and value:
+            return value
+    return None
+
 # We can't call the auth0 /userinfo endpoint with each request because
 # of a rate limit (something like 5-10/minute). So we just cache the
-# response in the database and reuse it. We also prune any cached
-# responses older than 10 hours because they're no longer valid.
-def get_userinfo(token):
-    check = database.db_check_userinfo(token)
-    if check: return check
-    url = f"https://{auth0_domain}/userinfo"
+# response and reuse it, in two tiers: this worker's memory first,
+# then the userinfo table (shared by all instances). Both forget a
+# response after 10 hours because the token is no longer valid.
+#
+# The frontend sends several requests at once with a new token, so they
+# share one lookup (userinfo_flight), and calls to Auth0 are paced per
+# user by userinfo_governor instead of running into the rate limit.
+userinfo_flight = SingleFlight()
+userinfo_governor = KeyedTokenBuckets(userinfo_rate_per_minute / 60, userinfo_burst,
+                                      maxsize=userinfo_governor_users)
+
+@metrics.instrumented(stage="userinfo")
+def get_userinfo(token, expires_at=None):
+    token_key = token_cache_key(token)
+    data = userinfo_cache.get(token_key)
+    if data is not None:
+        return data
+    data = userinfo_flight.do(token_key, load_userinfo, token)
+    userinfo_cache.set(token_key, data, expires_at=expires_at)
+    return data
+
+
+def load_userinfo(token):
+    data = database.db_check_userinfo(token)
+    if data is None:
+        # Don't hold a database connection while waiting on the
+        # governor and Auth0
+        database.release_request_session()
+        data = fetch_userinfo(token)
+        database.db_cache_userinfo(token, data)
+    return data
+
+
+def userinfo_rate_key(token):
+    """Returns the user (the token's "sub") that Auth0 counts a
+    /userinfo call against. The token has already been verified.
+    """
+    try:
+        sub = jwt.get_unverified_claims(token).get("sub")
+    except JWTError:
+        sub = None
+    return sub or token_cache_key(token)
+
+
+def fetch_userinfo(token):
+    if not userinfo_governor.acquire(userinfo_rate_key(token), userinfo_max_wait):
+        raise userinfo_rate_limited()
+    url = f"{auth0_base_url}/userinfo"
     headers = {
         "Authorization": f"Bearer {token}"
     }
-    response = requests.get(url, headers=headers)
+    response = http_client.get_client().get(url, headers=headers)
     if response.status_code != 200:
         raise AuthError({"code": "userinfo_request_failed", "description": "Failed to fetch user info"}, response.status_code)
-    data = response.json()
-    database.db_cache_userinfo(token, data)
-    return data
+    return response.json()
+
+
+def userinfo_rate_limited():
+    return AuthError({"code": "userinfo_rate_limited",
+                      "description": "Too many user info requests, try again later"}, 429)
 
 
 # This doesn't need authentication
@@ -150,6 +307,44 @@ def public():
     return response
 
 
+# Connection pool usage, to see when requests queue on connections
+@APP.route("/api/pool_stats")
+@requires_auth
+def pool_stats():
+    return jsonify(database.db_pool_stats())
+
+
+# Per-host latency and connection reuse of outbound calls (Auth0, OpenAI)
+@APP.route("/api/http_stats")
+@requires_auth
+def http_stats():
+    return jsonify(http_client.stats())
+
+
+# Per-endpoint SQL statement counts and the latest slow statements, with
+# DB_PROFILE=1 (see query_profiler.py)
+@APP.route("/api/query_stats")
+@requires_auth
+def query_stats():
+    return jsonify({"endpoints": query_profiler.stats(),
+                    "slow_queries": query_profiler.slow_queries()})
+
+
+# Latency histograms for Prometheus to scrape, and the pool/cache gauges
+# for a scraper with the METRICS_TOKEN (see config.py)
+@APP.route("/api/metrics")
+def prometheus_metrics():
+    return Response(metrics.exposition(gauges=is_metrics_scraper()),
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def is_metrics_scraper():
+    if metrics_token is None:
+        return False
+    expected = ("Bearer " + metrics_token).encode()
+    return hmac.compare_digest(request.headers.get("Authorization", "").encode(), expected)
+
+
 # This needs authentication
 @APP.route("/api/private")
 @requires_auth
@@ -165,16 +360,59 @@ def maps_api_key():
     key = google_secrets.get_secret("maps_api_key")
     return jsonify(message=key)
 
+# Fields that can be requested from the paginated trip lists
+TRIP_LIST_FIELDS = ("uuid", "name", "role", "updated_at")
+
+def is_paginated():
+    return any(arg in request.args for arg in ("limit", "cursor", "fields"))
+
+# Returns one page of trips as {"trips": [...], "next_cursor": ...}.
+# See "Pagination" in API.md.
+def trips_page(email, scope):
+    try:
+        limit, fields, cursor = parse_page_args(request.args, scope)
+        trips, next_cursor = database.db_list_trips(email, scope, limit, cursor)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"trips": page_objects(trips, fields), "next_cursor": next_cursor})
+
+def parse_page_args(args, scope):
+    """
+    Returns (limit, fields, cursor) from the query arguments of a trip
+    list, raising ValueError for invalid ones.
+    """
+    try:
+        limit = int(args.get('limit', trip_page_size))
+    except ValueError:
+        raise ValueError("Invalid limit.")
+    limit = max(1, min(limit, max_trip_page_size))
+    fields = args.get('fields', None)
+    if fields is None:
+        fields = ["uuid", "name", "role"] if scope == "all" else ["uuid", "name"]
+    else:
+        fields = [field.strip() for field in fields.split(',')]
+        if not set(fields) <= set(TRIP_LIST_FIELDS):
+            raise ValueError(f"fields must be among {', '.join(TRIP_LIST_FIELDS)}.")
+    return limit, fields, args.get('cursor', None)
+
+def page_objects(trips, fields):
+    objects = []
+    for uuid, name, role, updated_at in trips:
+        trip = {"uuid": uuid, "name": name if name is not None else "", "role": role, "updated_at": updated_at}
+        objects.append({field: trip[field] for field in fields})
+    return objects
+
 # Returns a list of trip IDs and names for
 # trips owned by the authenticated user.
 @APP.route("/api/private/get_owned_trips_list")
 @requires_auth
 def get_owned_trips_list():
     email = request_ctx.user_info.get("email")
+    if is_paginated():
+        return trips_page(email, "owned")
     trips = database.db_get_owned_trips(email)
-    objects = [{"uuid": str(uuid), "name": name if name is not None else ""} for uuid, name in trips]
-    data = jsonify(objects)
-    return data.json
+    objects = [{"uuid": uuid, "name": name if name is not None else ""} for uuid, name in trips]
+    return jsonify(objects)
 
 # STUB
 # Returns a list of trip IDs and names for trips that have been shared
@@ -183,12 +421,37 @@ def get_owned_trips_list():
 @requires_auth
 def get_shared_trips_list():
     email = request_ctx.user_info.get("email")
+    if is_paginated():
+        return trips_page(email, "shared")
     trips = database.db_get_shared_trips(email)
-    objects = [{"uuid": str(uuid), "name": name if name is not None else ""} for uuid, name in trips]
-    data = jsonify(objects)
-    return data.json
+    objects = [{"uuid": uuid, "name": name if name is not None else ""} for uuid, name in trips]
+    return jsonify(objects)
 
-from llm import match_to_places_api_types
+# Returns one page of all trips the authenticated user owns or that are
+# shared with them, with the user's role for each.
+@APP.route("/api/private/get_trips_list")
+@requires_auth
+def get_trips_list():
+    email = request_ctx.user_info.get("email")
+    return trips_page(email, "all")
+
+with startup.timed("import llm"):
+    import llm
+    from llm import match_to_places_api_types
+
+metrics.register_gauges("db_pool", database.db_pool_stats)
+metrics.register_gauges("http", http_client.stats, label="host")
+metrics.register_gauges("jwks", jwks.stats)
+metrics.register_gauges("queries", query_profiler.stats, label="endpoint")
+metrics.register_gauges("userinfo_governor", userinfo_governor.stats)
+metrics.register_gauges("userinfo_sweep", lambda: dict(sweeper.last_sweep))
+metrics.register_gauges("cache", lambda: {
+    "verified_tokens": verified_tokens.stats(),
+    "userinfo": userinfo_cache.stats(),
+    "preference_types": llm.type_cache.stats(),
+    "type_matcher": llm.matcher.stats(),
+    "llm_in_flight": {"calls": llm.in_flight.calls, "coalesced": llm.in_flight.coalesced},
+}, label="cache")
 # Returns a list of google map "types" based on the preference tag
 # argument (using gpt4o-mini). Could be hardcoded in a map in the
 # frontend but this gives us a way to demo the LLM
@@ -207,6 +470,8 @@ def preferences_to_types():
 def save_trip():
     email = request_ctx.user_info.get("email")
     trip_id = request.args.get('trip_id', None)
+    if request.mimetype == "application/json-patch+json":
+        return patch_trip(email, trip_id)
     trip_name = request.args.get('trip_name', None)
     trip_data = request.json
     # lists of emails
@@ -220,23 +485,72 @@ def save_trip():
     id = database.db_save_trip(email, trip_id, trip_name, trip_data, view, edit)
     return str(id)
 
+# Patch mode of save_trip: the body is a JSON Patch (RFC 6902) against
+# the version of the trip given in If-Match (the ETag from get_trip) or
+# the "version" argument. Returns 409 with the current version if the
+# trip has been saved since.
+def patch_trip(email, trip_id):
+    if not trip_id:
+        return jsonify({"error": "trip_id is required to patch a trip."}), 400
+    expected_version = request.args.get('version', None)
+    if expected_version is None and request.if_match:
+        expected_version = next(iter(request.if_match.as_set()), None)
+    if expected_version is None:
+        return jsonify({"error": "The trip version is required (If-Match header or version argument)."}), 428
+    try:
+        expected_version = int(expected_version)
+    except ValueError:
+        return jsonify({"error": "Invalid trip version."}), 400
+
+    try:
+        version = database.db_patch_trip(email, trip_id, request.get_json(), expected_version)
+    except database.VersionConflictError as e:
+        return jsonify({"error": str(e), "version": e.current_version}), 409
+    except database.PatchError as e:
+        return jsonify({"error": str(e)}), 422
+    except PermissionError as e:
+        return jsonify({"error": str(e)}), 403
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    response = make_response(trip_id)
+    response.set_etag(str(version))
+    return response
+
 # Returns the JSON trip structure if the authenticated user has
 # permissions to view the trip.
+#
+# The trip version is sent as the ETag. If the client sends it back in
+# If-None-Match and the trip hasn't changed, we answer 304 Not Modified
+# without reading trip_data at all.
 @APP.route("/api/private/get_trip", methods=['POST'])
 @requires_auth
 def get_trip():
     email = request_ctx.user_info.get("email")
     trip_id = request.args.get('trip_id', None)
-    data = jsonify(database.db_get_trip(email, trip_id))
-    return data.json
+    try:
+        if request.if_none_match:
+            version = database.db_get_trip_version(email, trip_id)
+            if request.if_none_match.contains(str(version)):
+                response = Response(status=304)
+                response.set_etag(str(version))
+                return response
+        # trip_data is passed through as the JSON text Postgres
+        # produces, without building Python objects from it
+        trip_json, version = database.db_get_trip_json(email, trip_id)
+    except PermissionError as e:
+        return jsonify({"error": str(e)}), 403
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    response = Response(trip_json, mimetype="application/json")
+    response.set_etag(str(version))
+    return response
 
 # Returns the JSON preferences stored in the db for the authenticated user.
 @APP.route("/api/private/get_preferences")
 @requires_auth
 def get_preferences():
     email = request_ctx.user_info.get("email")
-    data = jsonify(database.db_get_preferences(email))
-    return (data.json)
+    return jsonify(database.db_get_preferences(email))
 
 # saves the JSON body of the request as user preferences in the db
 @APP.route("/api/private/save_preferences", methods=['POST'])
@@ -299,6 +613,23 @@ def get_trip_editors():
     except ValueError as e:
         return jsonify({"error": str(e)}), 404
 
+# Returns the name, ownership, edit permission, viewers and editors of
+# one or more trips (comma separated trip_id), replacing separate calls
+# to get_trip_name, get_is_trip_owner, get_can_edit, get_trip_viewers
+# and get_trip_editors.
+@APP.route("/api/private/get_trip_metadata", methods=['GET'])
+@requires_auth
+def get_trip_metadata():
+    email = request_ctx.user_info.get("email")
+    trip_ids = request.args.get('trip_id', None)
+    if not trip_ids:
+        return jsonify({"error": "trip_id is required."}), 400
+    trip_ids = [trip_id.strip() for trip_id in trip_ids.split(',') if trip_id.strip()]
+    if len(trip_ids) > max_batch_trips:
+        return jsonify({"error": f"At most {max_batch_trips} trips per request."}), 400
+    trips = database.db_get_trips_metadata(email, trip_ids)
+    return jsonify({"trips": trips}), 200
+
 @APP.route("/api/private/get_is_trip_owner", methods=['GET'])
 @requires_auth
 def get_is_trip_owner():
@@ -315,5 +646,29 @@ def get_can_edit():
     can_edit = database.db_can_edit(email, trip_id)
     return jsonify({"can_edit": can_edit}), 200
 
+# Secrets, the database engine, the OpenAI client and the Auth0 keys are
+# all created lazily on first use. To keep that cost off the first
+# requests we also create them here, concurrently, on a background
+# thread once the app is imported (under gunicorn the port is already
+# bound by then), and log the startup timing report.
+def warm_up():
+    with startup.timed("warm up"):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            tasks = [
+                pool.submit(google_secrets.prefetch, ["db_ip", "db_password", "openai", "maps_api_key"]),
+                pool.submit(database.warm_up),
+                pool.submit(llm.get_client),
+                pool.submit(jwks.preload),
+            ]
+            for task in tasks:
+                try:
+                    task.result()
+                except Exception as e:
+                    print(f"Warm up step failed (will retry on first use): {e!r}")
+    startup.report(cold_start_budget)
+
+if warm_up_on_start:
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
 if __name__ == '__main__':
     APP.run(host="0.0.0.0", port=port, debug=True)
@@ -0,0 +1,294 @@
+# ASGI entry point, an asyncio alternative to serving app:APP with
+# gunicorn threads:
+#
+#   uvicorn asgi:app --host 0.0.0.0 --port $PORT
+#
+# Under gunicorn every request holds one of the 8 threads while it
+# waits on Auth0, Postgres, Secret Manager or OpenAI, so 8 slow upstream
+# calls stall the instance. Here the busiest endpoints are served on the
+# event loop instead (async_database.py, http_client.py and AsyncOpenAI), and one
+# instance can have hundreds of requests in flight. Every other route is
+# handed to the Flask app, which asgiref runs in a thread pool exactly
+# as under gunicorn, so both modes serve the same API.
+#
+# The native handlers mirror the Flask views of the same name in app.py
+# and share its caches (verified_tokens, userinfo_cache) and helpers.
+
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_etags, quote_etag
+
+import app as flask_app
+import async_database
+import http_client
+import llm
+import metrics
+import query_profiler
+from singleflight import AsyncSingleFlight
+from config import auth0_base_url, client_origin_url, warm_up_on_start
+from app import AuthError
+
+logger = logging.getLogger(__name__)
+
+wsgi = WsgiToAsgi(flask_app.APP)
+
+class Request:
+    """
+    The parts of an ASGI http request the native handlers use.
+    """
+
+    def __init__(self, scope, receive):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1")
+                        for name, value in scope["headers"]}
+        query = parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        # Like Flask's request.args.get, the first value of each argument
+        self.args = {name: values[0] for name, values in query.items()}
+        self._receive = receive
+
+    async def body(self):
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await self._receive()
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        return b"".join(chunks)
+
+
+class Response:
+
+    def __init__(self, body=b"", status=200, mimetype=None, etag=None):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.status = status
+        self.headers = []
+        if mimetype:
+            self.headers.append(("content-type", mimetype))
+        if etag is not None:
+            self.headers.append(("etag", quote_etag(etag)))
+
+    async def send(self, send, origin=None, timing=None):
+        headers = self.headers + cors_headers(origin)
+        if timing is not None:
+            headers.append(("server-timing", timing))
+            headers.append(("timing-allow-origin", client_origin_url))
+        headers.append(("content-length", str(len(self.body))))
+        await send({"type": "http.response.start", "status": self.status,
+                    "headers": [(name.encode("latin-1"), value.encode("latin-1"))
+                                for name, value in headers]})
+        await send({"type": "http.response.body", "body": self.body})
+
+
+def jsonify(obj, status=200):
+    # Same encoder (and output) as Flask's jsonify
+    with metrics.timed("json"):
+        body = flask_app.APP.json.dumps(obj) + "\n"
+    return Response(body, status, "application/json")
+
+
+def cors_headers(origin):
+    """
+    The CORS response headers flask-cors adds to the Flask routes (see
+    the CORS(...) call in app.py). Preflight requests go to Flask.
+    """
+    if not origin:
+        return []
+    if client_origin_url == "*":
+        allowed = "*"
+    elif origin == client_origin_url:
+        allowed = origin
+    else:
+        return []
+    return [("access-control-allow-origin", allowed),
+            ("access-control-expose-headers", "ETag, Server-Timing"),
+            ("vary", "Origin")]
+
+
+# Async version of app.requires_auth. Returns the user info.
+async def authenticate(request):
+    token = flask_app.parse_auth_header(request.headers.get("authorization"))
+    token_key = flask_app.token_cache_key(token)
+    payload = flask_app.verified_tokens.get(token_key)
+    if payload is None:
+        # Can block on a JWKS fetch (only when the keys expire or rotate)
+        payload = await asyncio.to_thread(flask_app.verify_token, token)
+        if "exp" in payload:
+            flask_app.verified_tokens.set(token_key, payload, expires_at=payload["exp"])
+    email = flask_app.email_claim(payload)
+    if email is not None:
+        return {"email": email}
+    return await get_userinfo(token, payload.get("exp"))
+
+
+# Async version of app.get_userinfo, with the same two cache tiers and
+# per-user rate limit (app.userinfo_governor is shared by both modes)
+userinfo_flight = AsyncSingleFlight()
+
+
+@metrics.instrumented(stage="userinfo")
+async def get_userinfo(token, expires_at=None):
+    token_key = flask_app.token_cache_key(token)
+    data = flask_app.userinfo_cache.get(token_key)
+    if data is not None:
+        return data
+    data = await userinfo_flight.do(token_key, load_userinfo, token)
+    flask_app.userinfo_cache.set(token_key, data, expires_at=expires_at)
+    return data
+
+
+async def load_userinfo(token):
+    data = await async_database.db_check_userinfo(token)
+    if data is None:
+        data = await fetch_userinfo(token)
+        await async_database.db_cache_userinfo(token, data)
+    return data
+
+
+async def fetch_userinfo(token):
+    wait = flask_app.userinfo_governor.reserve(flask_app.userinfo_rate_key(token),
+                                               flask_app.userinfo_max_wait)
+    if wait is None:
+        raise flask_app.userinfo_rate_limited()
+    if wait:
+        await asyncio.sleep(wait)
+    response = await http_client.get_async_client().get(
+        f"{auth0_base_url}/userinfo", headers={"Authorization": f"Bearer {token}"})
+    if response.status_code != 200:
+        raise AuthError({"code": "userinfo_request_failed", "description": "Failed to fetch user info"}, response.status_code)
+    return response.json()
+
+
+def requires_auth(handler):
+    async def decorated(request):
+        user_info = await authenticate(request)
+        return await handler(request, user_info.get("email"))
+    return decorated
+
+
+@requires_auth
+async def get_trip(request, email):
+    trip_id = request.args.get('trip_id', None)
+    if_none_match = request.headers.get("if-none-match")
+    try:
+        if if_none_match:
+            version = await async_database.db_get_trip_version(email, trip_id)
+            if parse_etags(if_none_match).contains(str(version)):
+                return Response(status=304, etag=str(version))
+        trip_json, version = await async_database.db_get_trip_json(email, trip_id)
+    except PermissionError as e:
+        return jsonify({"error": str(e)}, 403)
+    except ValueError as e:
+        return jsonify({"error": str(e)}, 404)
+    return Response(trip_json, mimetype="application/json", etag=str(version))
+
+
+def trips_page(scope):
+    @requires_auth
+    async def handler(request, email):
+        try:
+            limit, fields, cursor = flask_app.parse_page_args(request.args, scope)
+            trips, next_cursor = await async_database.db_list_trips(email, scope, limit, cursor)
+        except ValueError as e:
+            return jsonify({"error": str(e)}, 400)
+        return jsonify({"trips": flask_app.page_objects(trips, fields), "next_cursor": next_cursor})
+    return handler
+
+
+@requires_auth
+async def get_preferences(request, email):
+    return jsonify(await async_database.db_get_preferences(email))
+
+
+async def preferences_to_types(request):
+    try:
+        data = json.loads(await request.body())
+    except ValueError:
+        return jsonify({"error": "The body must be JSON."}, 400)
+    input_list = data.get('input_list', [])
+    matched_list = await llm.match_to_places_api_types_async(input_list)
+    return jsonify({'matched_list': matched_list.types})
+
+
+# (method, path) -> handler for the routes served on the event loop
+ROUTES = {
+    ("POST", "/api/private/get_trip"): get_trip,
+    ("GET", "/api/private/get_trips_list"): trips_page("all"),
+    ("GET", "/api/private/get_preferences"): get_preferences,
+    ("POST", "/api/public/preferences_to_types"): preferences_to_types,
+}
+
+# The old trip list endpoints are native only in pagination mode, the
+# unpaginated lists go to Flask.
+PAGINATED_ROUTES = {
+    ("GET", "/api/private/get_owned_trips_list"): trips_page("owned"),
+    ("GET", "/api/private/get_shared_trips_list"): trips_page("shared"),
+}
+
+
+def find_handler(request):
+    handler = ROUTES.get((request.method, request.path))
+    if handler is None and any(arg in request.args for arg in ("limit", "cursor", "fields")):
+        handler = PAGINATED_ROUTES.get((request.method, request.path))
+    return handler
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if warm_up_on_start:
+                asyncio.get_running_loop().create_task(warm_up())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# app.py warms up the Flask side on import; this adds the async
+# database engine and OpenAI client.
+async def warm_up():
+    try:
+        async with async_database.transaction():
+            pass
+        await llm.get_async_client()
+    except Exception as e:
+        print(f"Async warm up failed (will retry on first use): {e!r}")
+
+
+async def close():
+    await http_client.aclose()
+    await async_database.dispose()
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        await wsgi(scope, receive, send)
+        return
+    request = Request(scope, receive)
+    handler = find_handler(request)
+    if handler is None:
+        await wsgi(scope, receive, send)
+        return
+    # Same endpoint names as the Flask views
+    endpoint = request.path.rsplit("/", 1)[-1]
+    timing = metrics.start_request(endpoint)
+    query_profile = query_profiler.start_request(endpoint)
+    try:
+        response = await handler(request)
+    except AuthError as e:
+        response = jsonify(e.error, e.status_code)
+    except Exception:
+        logger.exception("Error handling %s %s", request.method, request.path)
+        response = Response("Internal Server Error", 500, "text/plain")
+    query_profiler.finish_request(query_profile)
+    header = metrics.finish_request(timing, request.method, response.status)
+    await response.send(send, request.headers.get("origin"), header)
@@ -0,0 +1,157 @@
+# Async counterparts of the database.py functions used by the ASGI
+# serving mode (asgi.py), on SQLAlchemy's asyncio engine with asyncpg,
+# so a request waiting on Postgres doesn't hold a thread. The queries
+# come from the builders in database.py; only how they are executed
+# differs. Each function has the same name, arguments, return value
+# and exceptions as its counterpart there.
+
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+from config import (db_name, db_pool_size, db_max_overflow, db_pool_timeout,
+                    db_pool_recycle, db_pool_pre_ping, db_pgbouncer, db_profile)
+from google_secrets import get_secret
+import database
+import metrics
+import query_profiler
+import startup
+
+# Created on first use, like database.engine
+engine = None
+_engine_lock = asyncio.Lock()
+
+
+def create_db_engine(db_url):
+    """
+    Async version of database.create_db_engine. Unlike psycopg2, asyncpg
+    prepares every statement, which PgBouncer's transaction pooling
+    doesn't support, so in PgBouncer mode its statement caches are off
+    and prepared statements get unique names.
+    """
+    if db_pgbouncer:
+        return create_async_engine(
+            db_url + "?prepared_statement_cache_size=0", poolclass=NullPool,
+            connect_args={"statement_cache_size": 0,
+                          "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__"})
+    return create_async_engine(db_url,
+                               pool_size=db_pool_size,
+                               max_overflow=db_max_overflow,
+                               pool_timeout=db_pool_timeout,
+                               pool_recycle=db_pool_recycle,
+                               pool_pre_ping=db_pool_pre_ping)
+
+
+async def get_engine():
+    global engine
+    if engine is None:
+        async with _engine_lock:
+            if engine is None:
+                with startup.timed("init async database engine"):
+                    # get_secret can block on Secret Manager
+                    db_ip = await asyncio.to_thread(get_secret, "db_ip")
+                    db_password = await asyncio.to_thread(get_secret, "db_password")
+                    db_url = f'postgresql+asyncpg://{database.db_user}:{db_password}@{db_ip}/{db_name}'
+                    new_engine = create_db_engine(db_url)
+                    if db_profile:
+                        # The engine events run on the sync engine inside
+                        query_profiler.attach(new_engine.sync_engine)
+                    engine = new_engine
+    return engine
+
+
+async def dispose():
+    global engine
+    if engine is not None:
+        await engine.dispose()
+        engine = None
+
+
+@asynccontextmanager
+async def transaction():
+    """
+    Yields an AsyncConnection in a transaction that is committed when
+    the block exits, or rolled back if it raises.
+    """
+    query_profiler.session_opened()
+    async with (await get_engine()).begin() as conn:
+        yield conn
+
+
+def parse_trip_id(trip_id):
+    # asyncpg only takes uuid.UUID for uuid columns
+    try:
+        return uuid.UUID(str(trip_id))
+    except ValueError:
+        raise ValueError("Trip not found.")
+
+
+async def _check_exists(conn, trip_id, action):
+    if (await conn.execute(database.trip_exists_query(trip_id))).scalar():
+        raise PermissionError(f"Authenticated user does not have permission to {action} this trip.")
+    raise ValueError("Trip not found.")
+
+
+@metrics.instrumented
+async def db_get_trip_json(authenticated_user, trip_id):
+    trip_id = parse_trip_id(trip_id)
+    async with transaction() as conn:
+        row = (await conn.execute(database.trip_json_query(authenticated_user, trip_id))).one_or_none()
+        if row is None:
+            await _check_exists(conn, trip_id, "view")
+        trip_json = row.trip_json if row.trip_json is not None else "null"
+        return trip_json, row.version
+
+
+@metrics.instrumented
+async def db_get_trip_version(authenticated_user, trip_id):
+    trip_id = parse_trip_id(trip_id)
+    async with transaction() as conn:
+        row = (await conn.execute(database.trip_version_query(authenticated_user, trip_id))).one_or_none()
+        if row is None:
+            await _check_exists(conn, trip_id, "view")
+        return row.version
+
+
+@metrics.instrumented
+async def db_list_trips(authenticated_user, scope="all", limit=50, cursor=None):
+    query = database.list_trips_query(authenticated_user, scope, limit, cursor)
+    async with transaction() as conn:
+        rows = (await conn.execute(query)).all()
+    return database.trips_page(rows, limit)
+
+
+@metrics.instrumented
+async def db_get_preferences(user):
+    async with transaction() as conn:
+        return (await conn.execute(database.preferences_query(user))).scalar_one_or_none()
+
+
+@metrics.instrumented
+async def db_check_userinfo(token):
+    async with transaction() as conn:
+        return (await conn.execute(database.userinfo_query(token))).scalar_one_or_none()
+
+
+@metrics.instrumented
+async def db_cache_userinfo(token, data):
+    async with transaction() as conn:
+        await conn.execute(database.cache_userinfo_statement(token, data))
+
+
+@metrics.instrumented
+async def db_get_cached_types(terms, max_age):
+    async with transaction() as conn:
+        rows = (await conn.execute(database.cached_types_query(terms, max_age))).all()
+        return {row.term: row.types for row in rows}
+
+
+@metrics.instrumented
+async def db_cache_types(matches):
+    if not matches:
+        return
+    async with transaction() as conn:
+        await conn.execute(database.cache_types_statement(matches))
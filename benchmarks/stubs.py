@@ -0,0 +1,163 @@
+# Local stand-ins for the services the backend calls, so benchmarks
+# can run offline: Auth0 (JWKS, /userinfo and a signer for access
+# tokens) and the OpenAI chat completions API, all served by one
+# threaded HTTP server. Secret Manager is replaced by the app's local
+# secrets backend (SECRETS_BACKEND=local), see load_test.py.
+#
+# Point the app at it with AUTH0_BASE_URL=<url> and
+# OPENAI_BASE_URL=<url>/v1.
+
+import ast
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from jose import jwt
+
+KID = "bench-key"
+
+
+def b64url_uint(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+class StubAuth0:
+    """
+    Signs access tokens the way our Auth0 tenant does (RS256, with a
+    kid from the JWKS), for users identified by email.
+    """
+
+    def __init__(self, domain, audience):
+        self.domain = domain
+        self.audience = audience
+        public_key, private_key = rsa.newkeys(2048)
+        self._private_pem = private_key.save_pkcs1().decode()
+        self.jwks = {"keys": [{
+            "kty": "RSA", "kid": KID, "use": "sig", "alg": "RS256",
+            "n": b64url_uint(public_key.n), "e": b64url_uint(public_key.e),
+        }]}
+
+    def token(self, email, lifetime=3600, email_claim=False):
+        now = int(time.time())
+        claims = {
+            "iss": f"https://{self.domain}/",
+            "sub": f"auth0|{email}",
+            "aud": self.audience,
+            "iat": now,
+            "exp": now + lifetime,
+        }
+        if email_claim:
+            claims["https://dayscape/email"] = email
+        return jwt.encode(claims, self._private_pem, algorithm="RS256", headers={"kid": KID})
+
+
+class StubServer:
+    """
+    Serves /.well-known/jwks.json, /userinfo and
+    /v1/chat/completions on 127.0.0.1.
+
+    Parameters:
+    - auth0: The StubAuth0 whose keys are served (None to only serve
+      the OpenAI API, as in tests/llm_test.py).
+    - userinfo_delay / llm_delay: Seconds to wait before answering, to
+      simulate the real services' latency.
+    - llm_types: The types every term is matched to.
+
+    Setting llm_failures makes that many chat completions fail with a
+    500 before the stub answers again.
+    """
+
+    def __init__(self, auth0, userinfo_delay=0.05, llm_delay=0.5, llm_types=("tourist_attraction",)):
+        self.auth0 = auth0
+        self.userinfo_delay = userinfo_delay
+        self.llm_delay = llm_delay
+        self.llm_types = list(llm_types)
+        self.llm_failures = 0
+        self.counts = {"jwks": 0, "userinfo": 0, "llm": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="stubs", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _llm_fails(self):
+        with self._lock:
+            self.counts["llm"] += 1
+            fail = self.llm_failures > 0
+            self.llm_failures -= fail
+            return fail
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if stub.auth0 is None:
+                    self._send(404, {"error": "not found"})
+                elif self.path == "/.well-known/jwks.json":
+                    stub._count("jwks")
+                    self._send(200, stub.auth0.jwks, {"Cache-Control": "public, max-age=86400"})
+                elif self.path == "/userinfo":
+                    stub._count("userinfo")
+                    time.sleep(stub.userinfo_delay)
+                    token = self.headers.get("Authorization", "").split()[-1]
+                    sub = jwt.get_unverified_claims(token)["sub"]
+                    self._send(200, {"sub": sub, "email": sub.split("|", 1)[1], "email_verified": True})
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    self._send(404, {"error": "not found"})
+                    return
+                fail = stub._llm_fails()
+                time.sleep(stub.llm_delay)
+                if fail:
+                    self._send(500, {"error": {"message": "overloaded", "type": "server_error"}})
+                    return
+                # The app sends "Input list: [...]"
+                terms = ast.literal_eval(body["messages"][-1]["content"].split(": ", 1)[1])
+                content = json.dumps({"matches": [
+                    {"term": term, "types": stub.llm_types} for term in terms]})
+                self._send(200, {
+                    "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+                    "model": body.get("model", "stub"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                })
+
+            def _send(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    for name, value in (headers or {}).items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up (e.g. the LLM deadline)
+                    pass
+
+        return Handler
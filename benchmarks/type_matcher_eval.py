@@ -0,0 +1,92 @@
+# Offline evaluation of the local preference matcher (type_matcher.py)
+# against the LLM.
+#
+# For each term, compares the types the local matcher returns with the
+# LLM's answer and reports the local hit rate, how often the two agree
+# and the disagreements. LLM answers come from a JSON file of
+# {"term": [types]} (e.g. an export of the preference_types table:
+#   psql -At -c "SELECT json_object_agg(term, types) FROM preference_types" > answers.json
+# ) or, with --live, from the model itself (needs the "openai" secret).
+#
+# Usage:
+#   python benchmarks/type_matcher_eval.py --answers answers.json
+#   SECRETS_BACKEND=local python benchmarks/type_matcher_eval.py --terms terms.txt --live
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import llm
+from type_matcher import TypeMatcher
+
+# Used when no terms are given
+DEFAULT_TERMS = [
+    "zoo", "bars", "art galleries", "cafés", "museums", "nightlife", "coffee",
+    "hiking", "shopping", "beaches", "live music", "history", "street food",
+    "kids", "romantic", "wine tasting", "theme parks", "aquariums", "spa day",
+    "architecture", "bookstores", "sports", "vegan", "churches", "markets",
+]
+
+
+def load_terms(args, answers):
+    if args.terms:
+        with open(args.terms) as f:
+            return [line.strip() for line in f if line.strip()]
+    if answers:
+        return list(answers)
+    return DEFAULT_TERMS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--answers", help="JSON file of term -> LLM types")
+    parser.add_argument("--terms", help="file with one term per line")
+    parser.add_argument("--live", action="store_true", help="ask the LLM for terms without an answer")
+    parser.add_argument("--threshold", type=float, default=llm.type_match_threshold)
+    args = parser.parse_args()
+
+    answers = {}
+    if args.answers:
+        with open(args.answers) as f:
+            answers = {llm.normalize_term(term): types for term, types in json.load(f).items()}
+    terms = list(dict.fromkeys(llm.normalize_term(term) for term in load_terms(args, answers)))
+
+    missing = [term for term in terms if term not in answers]
+    if missing and args.live:
+        answers.update(llm.ask_llm(missing))
+
+    matcher = TypeMatcher(llm.places_api_types, args.threshold)
+    start = time.perf_counter()
+    local = {term: matcher.match(term) for term in terms}
+    elapsed = time.perf_counter() - start
+
+    matched = [term for term in terms if local[term] is not None]
+    compared = [term for term in matched if term in answers]
+    exact = [term for term in compared if set(local[term]) == set(answers[term])]
+    overlap = [term for term in compared if set(local[term]) & set(answers[term])]
+
+    print(f"terms:               {len(terms)}")
+    print(f"local hit rate:      {len(matched) / max(1, len(terms)):.1%} "
+          f"({matcher.fuzzy_hits} fuzzy), {elapsed / max(1, len(terms)) * 1e6:.1f} us/term")
+    print(f"compared with LLM:   {len(compared)}")
+    print(f"exact agreement:     {len(exact) / max(1, len(compared)):.1%}")
+    print(f"partial agreement:   {len(overlap) / max(1, len(compared)):.1%}")
+
+    disagreements = [term for term in compared if term not in exact]
+    if disagreements:
+        print("\ndisagreements (term: local / llm):")
+        for term in disagreements:
+            print(f"  {term}: {local[term]} / {answers[term]}")
+    unmatched = [term for term in terms if local[term] is None]
+    if unmatched:
+        print("\nleft to the LLM:")
+        for term in unmatched:
+            print(f"  {term}: {answers.get(term, '?')}")
+
+
+if __name__ == "__main__":
+    main()
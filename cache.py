@@ -0,0 +1,83 @@
+# Small in-process caches shared by the request hot path.
+#
+# Every gunicorn worker has its own copy, so anything stored here must
+# be safe to lose (it's always backed by Auth0, the database, etc).
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded LRU map where every entry has an absolute
+    expiry time (epoch seconds). Expired entries are never returned.
+
+    Parameters:
+    - maxsize: Maximum number of entries before the least recently used is evicted.
+    - ttl: (Optional) Default lifetime in seconds for entries set without an expiry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        """
+        Stores value under key. expires_at (epoch seconds) wins over ttl,
+        which wins over the cache's default ttl.
+        """
+        if expires_at is None:
+            ttl = self.ttl if ttl is None else ttl
+            if ttl is not None:
+                expires_at = time.time() + ttl
+        if expires_at is not None and expires_at <= time.time():
+            return
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -7,6 +7,19 @@ gcloud_project_id = os.environ.get("PROJECT_ID", "263849479020")
 
 port = os.environ.get("PORT", 5556)
 
+# Where secrets come from: "gcp" (Secret Manager) or "local", which
+# reads SECRET_<NAME> environment variables or the JSON file below.
+secrets_backend = os.environ.get("SECRETS_BACKEND", "gcp")
+secrets_file = os.environ.get("SECRETS_FILE", ".secrets.json")
+# Seconds to cache a secret in memory before refreshing it
+secret_cache_ttl = int(os.environ.get("SECRET_CACHE_TTL", 60 * 60))
+
+# Create the database engine, OpenAI client, etc. in the background as
+# soon as the app starts instead of on first use, and the number of
+# seconds a cold start should take (logged with the startup report).
+warm_up_on_start = os.environ.get("WARM_UP_ON_START", "1") == "1"
+cold_start_budget = float(os.environ.get("COLD_START_BUDGET", 5))
+
 # As mentioned in the README, default values assume you are deploying
 # both frontend and backend on your workstation
 
@@ -25,8 +38,45 @@ auth0_audience = os.environ.get("AUTH0_AUDIENCE", DEV_URL if environment == "dev
 # Database connection string; prod and dev databases are both in the
 # same pg instance called dayscape-dev
 db_connector = "moonlit-mesh-437320-t8:us-east1:dayscape-dev"
-# Database name
-db_name = "dayscape-dev" if environment == "dev" else "dayscape-prod"
+# Database name (DB_NAME overrides it, e.g. for a benchmark database)
+db_name = os.environ.get("DB_NAME", "dayscape-dev" if environment == "dev" else "dayscape-prod")
+
+# Database connection pool (per gunicorn worker). The Dockerfile runs 8
+# threads per worker, so by default every thread can hold a connection,
+# with a little overflow for the background threads. Connections are
+# recycled well before Cloud SQL drops idle ones, and checked with a
+# ping on checkout. DB_PGBOUNCER=1 disables pooling in the app, for use
+# behind PgBouncer (or the Cloud SQL managed pooler).
+db_pool_size = int(os.environ.get("DB_POOL_SIZE", 8))
+db_max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", 2))
+db_pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+db_pool_recycle = int(os.environ.get("DB_POOL_RECYCLE", 30 * 60))
+db_pool_pre_ping = os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+db_pgbouncer = os.environ.get("DB_PGBOUNCER", "0") == "1"
+
+# Maximum number of trips in one get_trip_metadata request
+max_batch_trips = int(os.environ.get("MAX_BATCH_TRIPS", 100))
+
+# Cached preferences_to_types answers from the LLM: entries per
+# worker, and seconds before a term is sent to the model again.
+llm_cache_size = int(os.environ.get("LLM_CACHE_SIZE", 10000))
+llm_cache_ttl = int(os.environ.get("LLM_CACHE_TTL", 30 * 24 * 60 * 60))
+# OpenAI API endpoint (None for the default), e.g. a local stub server
+# for tests and benchmarks.
+openai_base_url = os.environ.get("OPENAI_BASE_URL", None)
+# At most this many LLM calls run at once per worker, each with a
+# deadline in seconds (including retries), after which
+# preferences_to_types answers without the LLM.
+llm_max_concurrency = int(os.environ.get("LLM_MAX_CONCURRENCY", 2))
+llm_timeout = float(os.environ.get("LLM_TIMEOUT", 8))
+llm_max_retries = int(os.environ.get("LLM_MAX_RETRIES", 2))
+# Minimum similarity (0-1) for type_matcher.py to fuzzy match a
+# preference term locally instead of asking the LLM
+type_match_threshold = float(os.environ.get("TYPE_MATCH_THRESHOLD", 0.85))
+
+# Default and maximum page size of the paginated trip lists
+trip_page_size = int(os.environ.get("TRIP_PAGE_SIZE", 50))
+max_trip_page_size = int(os.environ.get("MAX_TRIP_PAGE_SIZE", 500))
 
 # Deployments on Cloud Run must change the following variables to
 # match the corresponding frontend deployment URL
@@ -34,6 +84,68 @@ client_origin_url = os.environ.get("CLIENT_ORIGIN_URL", "http://localhost:3000")
 
 # This is the name of our Auth0 Tenant, you shouldn't need to change it.
 auth0_domain = os.environ.get("AUTH0_DOMAIN", "dev-dvzptx3ol842v42i.us.auth0.com")
+# Where the Auth0 APIs (JWKS, /userinfo) are called. Only changed to
+# point at a local stand-in (benchmarks/load_test.py); tokens are still
+# checked against the https://<auth0_domain>/ issuer.
+auth0_base_url = os.environ.get("AUTH0_BASE_URL", f"https://{auth0_domain}").rstrip("/")
+
+# Shared outbound HTTP client (http_client.py) for Auth0 and OpenAI:
+# connection pool size, idle keep-alive connections kept per pool and
+# for how many seconds, and connect/read timeouts in seconds. HTTP2=1
+# negotiates HTTP/2 where the server supports it (needs the h2 package).
+http_max_connections = int(os.environ.get("HTTP_MAX_CONNECTIONS", 20))
+http_max_keepalive = int(os.environ.get("HTTP_MAX_KEEPALIVE", 10))
+http_keepalive_expiry = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60))
+http_connect_timeout = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3))
+http_read_timeout = float(os.environ.get("HTTP_READ_TIMEOUT", 10))
+http2 = os.environ.get("HTTP2", "0").lower() in ("1", "true", "yes")
+
+# Seconds to cache the Auth0 signing keys (JWKS) when Auth0 doesn't
+# send a Cache-Control max-age.
+jwks_cache_ttl = int(os.environ.get("JWKS_CACHE_TTL", 600))
+
+# Maximum number of verified access tokens remembered per worker, so
+# repeat requests with the same token skip signature verification.
+token_cache_size = int(os.environ.get("TOKEN_CACHE_SIZE", 4096))
+
+# Seconds that cached Auth0 /userinfo responses stay valid. Our access
+# tokens live for 10 hours.
+userinfo_ttl = int(os.environ.get("USERINFO_TTL", 10 * 60 * 60))
+
+# Auth0 rate limits /userinfo per user (roughly 5-10 calls a minute).
+# Calls from this worker are limited to this many per minute per user
+# (the token's "sub"), with bursts of up to userinfo_burst; extra calls
+# wait their turn for up to userinfo_max_wait seconds before the request
+# fails with 429. Limits are kept for the userinfo_governor_users most
+# recently seen users.
+userinfo_rate_per_minute = float(os.environ.get("USERINFO_RATE_PER_MINUTE", 5))
+userinfo_burst = int(os.environ.get("USERINFO_BURST", 5))
+userinfo_max_wait = float(os.environ.get("USERINFO_MAX_WAIT", 30))
+userinfo_governor_users = int(os.environ.get("USERINFO_GOVERNOR_USERS", 4096))
+
+# How often (seconds) expired rows are purged from the userinfo table,
+# and how many rows are deleted per transaction. 0 disables the sweeper.
+userinfo_sweep_interval = int(os.environ.get("USERINFO_SWEEP_INTERVAL", 15 * 60))
+userinfo_sweep_batch = int(os.environ.get("USERINFO_SWEEP_BATCH", 1000))
+
+# Per-stage request timing (metrics.py): histograms served at
+# /api/metrics, and a Server-Timing header on every response.
+metrics_enabled = os.environ.get("METRICS_ENABLED", "1").lower() in ("1", "true", "yes")
+server_timing = os.environ.get("SERVER_TIMING", "1").lower() in ("1", "true", "yes")
+# The pool, upstream host, SQL and cache gauges describe the deployment,
+# so /api/metrics only includes them for a scraper that sends
+# "Authorization: Bearer <METRICS_TOKEN>". Without a token set, only the
+# latency histograms are served. (Not printed below.)
+metrics_token = os.environ.get("METRICS_TOKEN") or None
+
+# SQL profiling (query_profiler.py): per-endpoint statement counts, DB
+# time, rows and bytes at /api/query_stats, and a log of statements
+# slower than db_slow_query_ms (0 to disable) with their EXPLAIN plan.
+# Counting bytes re-reads every result, so this is off by default.
+db_profile = os.environ.get("DB_PROFILE", "0").lower() in ("1", "true", "yes")
+db_slow_query_ms = float(os.environ.get("DB_SLOW_QUERY_MS", 200))
+db_explain_slow = os.environ.get("DB_EXPLAIN_SLOW", "1").lower() in ("1", "true", "yes")
 
 print("Attempting to start server with the following configuration:")
-pprint.pprint(list(locals().items())[-8:])
+pprint.pprint([(k, v) for k, v in locals().items()
+               if not k.startswith("__") and k not in ("os", "pprint", "metrics_token")])
@@ -1,38 +1,164 @@
 # Direct code to connect to database. Anywhere 'user' is a parameter,
 # it means the user's email as a string.
 
-from datetime import datetime, timedelta, timezone
-from sqlalchemy import create_engine, Column, String, Text, JSON, ARRAY, func
-from sqlalchemy.dialects.postgresql import UUID, ARRAY, TIMESTAMP
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, Column, String, Text, JSON, ARRAY, BigInteger, func, select, update, delete, exists, any_, case, and_, cast, tuple_
+from sqlalchemy.dialects.postgresql import UUID, ARRAY, TIMESTAMP, JSONB, insert
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError, DataError, SQLAlchemyError
+from sqlalchemy.pool import QueuePool, NullPool
 from contextlib import contextmanager
+from flask import has_request_context
+from flask.globals import request_ctx
+import base64
+import json
+import threading
+import time
 import requests
 import uuid
 
-from config import db_connector, db_name, environment
+from config import (db_connector, db_name, environment, userinfo_ttl,
+                    db_pool_size, db_max_overflow, db_pool_timeout,
+                    db_pool_recycle, db_pool_pre_ping, db_pgbouncer, db_profile)
 
 from google_secrets import get_secret
+from json_patch import PatchError
+import json_patch
+import metrics
+import query_profiler
+import startup
 
-db_ip = get_secret("db_ip")
-db_password = get_secret("db_password")
 db_user = "dayscape"
 
-db_url = f'postgresql://{db_user}:{db_password}@{db_ip}/{db_name}'
+class VersionConflictError(Exception):
+  """
+  A trip was saved by someone else since the version the client has.
+  """
+  def __init__(self, current_version):
+    super().__init__(f"Trip has been modified, current version is {current_version}.")
+    self.current_version = current_version
+
+class TimedQueuePool(QueuePool):
+  """
+  QueuePool that records how long requests wait to check out a
+  connection, so we can tell when they queue behind the pool.
+  """
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.checkouts = 0
+    self.checkout_timeouts = 0
+    self.checkout_wait_total = 0.0
+    self.checkout_wait_max = 0.0
+
+  def _do_get(self):
+    start = time.perf_counter()
+    try:
+      return super()._do_get()
+    except PoolTimeoutError:
+      self.checkout_timeouts += 1
+      raise
+    finally:
+      waited = time.perf_counter() - start
+      self.checkouts += 1
+      self.checkout_wait_total += waited
+      self.checkout_wait_max = max(self.checkout_wait_max, waited)
+
+def create_db_engine(db_url):
+  """
+  Creates the engine with the pool settings from config.py. In
+  PgBouncer mode connections aren't pooled here at all (PgBouncer does
+  it), and psycopg2 never uses server-side prepared statements, which
+  PgBouncer's transaction pooling doesn't support.
+  """
+  if db_pgbouncer:
+    return create_engine(db_url, poolclass=NullPool)
+  return create_engine(db_url,
+                       poolclass=TimedQueuePool,
+                       pool_size=db_pool_size,
+                       max_overflow=db_max_overflow,
+                       pool_timeout=db_pool_timeout,
+                       pool_recycle=db_pool_recycle,
+                       pool_pre_ping=db_pool_pre_ping)
+
+def db_pool_stats():
+  """
+  Returns a dict describing the connection pool: connections in use,
+  overflow, and checkout wait times in seconds.
+  """
+  if engine is None:
+    return {"pool": None}
+  pool = engine.pool
+  if not isinstance(pool, TimedQueuePool):
+    return {"pool": type(pool).__name__}
+  return {
+    "pool": type(pool).__name__,
+    "size": pool.size(),
+    "checked_in": pool.checkedin(),
+    "checked_out": pool.checkedout(),
+    "overflow": max(0, pool.overflow()),
+    "checkouts": pool.checkouts,
+    "checkout_timeouts": pool.checkout_timeouts,
+    "checkout_wait_total": round(pool.checkout_wait_total, 6),
+    "checkout_wait_max": round(pool.checkout_wait_max, 6),
+  }
 
 # SQLAlchemy setup code
-# Create an engine
-engine = create_engine(db_url)
+# The engine is created on first use (see get_engine) so that importing
+# this module doesn't block on Secret Manager during a cold start.
+engine = None
+_engine_lock = threading.Lock()
 # Sqlalchemy ORM ( https://en.wikipedia.org/wiki/Object%E2%80%93relational_mapping )
 Base = declarative_base()
-# Bind the engine to the Base class to start using it
-Base.metadata.bind = engine
 # https://docs.sqlalchemy.org/en/20/orm/session_basics.html
-Session = sessionmaker(bind=engine)
+Session = sessionmaker()
+
+def get_engine():
+  global engine
+  if engine is None:
+    with _engine_lock:
+      if engine is None:
+        with startup.timed("init database engine"):
+          db_ip = get_secret("db_ip")
+          db_password = get_secret("db_password")
+          db_url = f'postgresql+psycopg2://{db_user}:{db_password}@{db_ip}/{db_name}'
+          new_engine = create_db_engine(db_url)
+          if db_profile:
+            query_profiler.attach(new_engine)
+          Session.configure(bind=new_engine)
+          engine = new_engine
+  return engine
+
+def warm_up():
+  """
+  Creates the engine and opens a first pooled connection.
+  """
+  with startup.timed("connect database"):
+    with get_engine().connect():
+      pass
 
 @contextmanager
 def session_scope():
 # variable to hold session. In SQLAlchemy, the session keeps track of
 # all changes, acts as a staging area for pending changes to objects.
+#
+# Inside a Flask request (see begin_request_session) every db_* call
+# shares the request's session, which is committed once at the end of
+# the request. Elsewhere (sweeper, warm up, other threads) each scope
+# is its own transaction.
+  unit = _request_unit()
+  if unit is not None:
+    session = unit.session()
+    try:
+      yield session
+    except SQLAlchemyError:
+      # The transaction can't be used any more (on Postgres it is
+      # aborted); roll back so later calls in the request still work
+      session.rollback()
+      raise
+    return
+
+  get_engine()
+  query_profiler.session_opened()
   session = Session()
   try:
     yield session
@@ -43,6 +169,83 @@ def session_scope():
   finally:
     session.close()
 
+class RequestUnit:
+  """
+  The session shared by the db_* calls of one request, opened on first
+  use. In read-only mode (GET requests) its connection is in AUTOCOMMIT:
+  no BEGIN or COMMIT round trips, every statement commits on its own.
+  That's safe as long as GET handlers only make single-statement writes
+  (the userinfo cache upsert, db_delete_trip).
+  """
+  def __init__(self, read_only):
+    self.read_only = read_only
+    self._session = None
+
+  def session(self):
+    if self._session is None:
+      bind = get_engine()
+      if self.read_only:
+        bind = bind.execution_options(isolation_level="AUTOCOMMIT")
+      query_profiler.session_opened()
+      self._session = Session(bind=bind)
+    return self._session
+
+  def commit(self):
+    if self._session is not None and not self.read_only:
+      self._session.commit()
+
+  def close(self):
+    # Returns the connection to the pool, rolling back anything not
+    # committed (e.g. when the request failed)
+    if self._session is not None:
+      self._session.close()
+      self._session = None
+
+def _request_unit():
+  if not has_request_context():
+    return None
+  return getattr(request_ctx, "db_unit", None)
+
+def begin_request_session(read_only=False):
+  """
+  Makes the db_* calls of the current Flask request share one session.
+
+  Parameters:
+  - read_only: Use an AUTOCOMMIT connection (see RequestUnit), e.g. for GET.
+  """
+  request_ctx.db_unit = RequestUnit(read_only)
+
+def commit_request_session():
+  """
+  Commits the current request's session, if it has one. Called before
+  the response is sent, so a failed commit is an error response.
+  """
+  unit = _request_unit()
+  if unit is not None:
+    unit.commit()
+
+def release_request_session():
+  """
+  Commits the current request's session and returns its connection to
+  the pool; later db_* calls in the request open a new one. Call it
+  before waiting on something slow (e.g. the LLM), so the connection
+  isn't held idle in a transaction meanwhile.
+  """
+  unit = _request_unit()
+  if unit is not None:
+    unit.commit()
+    unit.close()
+
+def end_request_session():
+  """
+  Closes the current request's session at teardown, rolling back
+  whatever commit_request_session didn't commit.
+  """
+  unit = _request_unit()
+  if unit is not None:
+    request_ctx.db_unit = None
+    unit.close()
+
 class Trip(Base):
     __tablename__ = 'trip'
     id = Column(UUID(as_uuid=True), primary_key=True)
@@ -50,7 +253,11 @@ class Trip(Base):
     name = Column(Text)
     viewers = Column(ARRAY(Text), default=[])
     editors = Column(ARRAY(Text), default=[])
-    trip_data = Column(JSON)
+    trip_data = Column(JSONB)
+    # Incremented by every save, used as the ETag of get_trip
+    version = Column(BigInteger, nullable=False, default=1, server_default="1")
+    # Time of the last save; trip lists are ordered by (updated_at, id)
+    updated_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
 
 class Preference(Base):
     __tablename__ = 'preference'
@@ -63,6 +270,36 @@ class UserInfo(Base):
     data = Column(JSON, nullable=False)
     created_at = Column(TIMESTAMP, server_default=func.now())
 
+# LLM answers for /api/public/preferences_to_types, one row per
+# normalized preference term (see llm.py)
+class PreferenceTypes(Base):
+    __tablename__ = 'preference_types'
+    term = Column(Text, primary_key=True)
+    types = Column(JSONB, nullable=False)
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now())
+
+# Permission predicates, evaluated by Postgres so that permission
+# checks only need the small owner/viewers/editors columns and never
+# load trip_data.
+def can_view(authenticated_user):
+    return ((Trip.owner == authenticated_user) |
+            (any_(Trip.viewers) == authenticated_user) |
+            (any_(Trip.editors) == authenticated_user))
+
+def can_edit(authenticated_user):
+    return (Trip.owner == authenticated_user) | (any_(Trip.editors) == authenticated_user)
+
+def trip_exists(session, trip_id):
+    return session.execute(trip_exists_query(trip_id)).scalar()
+
+# "viewers @> ARRAY[user]" rather than "user = ANY(viewers)": only the
+# containment form can use the GIN indexes on viewers and editors
+# (idx_trip_viewers, idx_trip_editors), the other is a sequential scan.
+def is_shared_with(authenticated_user):
+    return (Trip.viewers.contains([authenticated_user]) |
+            Trip.editors.contains([authenticated_user]))
+
+@metrics.instrumented
 def db_get_shared_trips(authenticated_user):
     """
     Retrieves a list of trip IDs and names for trips where the authenticated user
@@ -74,13 +311,11 @@ def db_get_shared_trips(authenticated_user):
     with session_scope() as session:
         trips = (
             session.query(Trip.id, Trip.name)
-            .filter(
-                (Trip.viewers.any(authenticated_user)) |
-                (Trip.editors.any(authenticated_user))
-            )
+            .filter(is_shared_with(authenticated_user))
             .all())
         return trips
 
+@metrics.instrumented
 def db_get_owned_trips(authenticated_user):
     """
     Retrieves a list of trip IDs and names for trips owned by the authenticated user.
@@ -95,6 +330,107 @@ def db_get_owned_trips(authenticated_user):
             .all())
         return trips
 
+def encode_cursor(updated_at, trip_id):
+    """
+    Returns an opaque continuation token for the trip lists, pointing
+    just after the trip with this (updated_at, id).
+    """
+    raw = json.dumps([updated_at.isoformat(), str(trip_id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        updated_at, trip_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(updated_at), uuid.UUID(trip_id)
+    except Exception:
+        raise ValueError("Invalid cursor.")
+
+@metrics.instrumented
+def db_list_trips(authenticated_user, scope="all", limit=50, cursor=None):
+    """
+    Retrieves one page of the trips the authenticated user owns and/or
+    that are shared with them, most recently saved first.
+
+    Parameters:
+    - authenticated_user: The email of the authenticated user.
+    - scope: "owned", "shared" or "all" (both, in one query).
+    - limit: Maximum number of trips to return.
+    - cursor: (Optional) The next_cursor returned with the previous page.
+
+    Returns:
+    - A tuple (trips, next_cursor), where trips is a list of tuples
+      (trip_id, trip_name, role, updated_at) with role "owner", "editor"
+      or "viewer", and next_cursor is None on the last page.
+    """
+    query = list_trips_query(authenticated_user, scope, limit, cursor)
+    with session_scope() as session:
+        rows = session.execute(query).all()
+    return trips_page(rows, limit)
+
+# Query builders shared with async_database.py (the ASGI mode), so the
+# SQL is the same whichever way it's executed.
+def list_trips_query(authenticated_user, scope, limit, cursor=None):
+    if scope == "owned":
+        condition = Trip.owner == authenticated_user
+    elif scope == "shared":
+        condition = is_shared_with(authenticated_user)
+    elif scope == "all":
+        condition = (Trip.owner == authenticated_user) | is_shared_with(authenticated_user)
+    else:
+        raise ValueError(f"Invalid scope: {scope}")
+
+    role = case((Trip.owner == authenticated_user, "owner"),
+                (Trip.editors.contains([authenticated_user]), "editor"),
+                else_="viewer")
+    query = (
+        select(Trip.id, Trip.name, role.label("role"), Trip.updated_at)
+        .where(condition)
+        .order_by(Trip.updated_at.desc(), Trip.id.desc())
+        .limit(limit + 1))
+    if cursor:
+        updated_at, trip_id = decode_cursor(cursor)
+        query = query.where(tuple_(Trip.updated_at, Trip.id) < tuple_(updated_at, trip_id))
+    return query
+
+def trips_page(rows, limit):
+    """
+    Returns (trips, next_cursor) from the rows of list_trips_query,
+    which fetches one row more than limit to tell if there's a next page.
+    """
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].updated_at, rows[-1].id)
+    return [tuple(row) for row in rows], next_cursor
+
+def trip_json_query(authenticated_user, trip_id):
+    return (
+        select(cast(Trip.trip_data, Text).label("trip_json"), Trip.version)
+        .where(Trip.id == trip_id, can_view(authenticated_user)))
+
+def trip_version_query(authenticated_user, trip_id):
+    return select(Trip.version).where(Trip.id == trip_id, can_view(authenticated_user))
+
+def trip_exists_query(trip_id):
+    return select(exists().where(Trip.id == trip_id))
+
+def preferences_query(user):
+    return select(Preference.preferences_data).where(Preference.email == user)
+
+# Start of the window of rows younger than seconds, computed by Postgres.
+# The created_at columns are TIMESTAMP WITHOUT TIME ZONE filled in by
+# the server, so the cutoff is too; binding a timezone-aware datetime
+# instead fails in asyncpg ("can't subtract offset-naive and
+# offset-aware datetimes").
+def cutoff(seconds):
+    return func.localtimestamp() - timedelta(seconds=seconds)
+
+def userinfo_query(token):
+    threshold_time = cutoff(userinfo_ttl)
+    return select(UserInfo.data).where(UserInfo.token == token, UserInfo.created_at >= threshold_time)
+
+@metrics.instrumented
 def db_save_trip(authenticated_user, trip_id=None,trip_name=None, trip_data=None, view=None, edit=None, ):
     """
     Saves the trip data structure to the database.
@@ -106,119 +442,298 @@ def db_save_trip(authenticated_user, trip_id=None,trip_name=None, trip_data=None
     - trip_data: (Optional) The data structure representing the trip.
 
     The authenticated_user will be marked as 'owner' of the trip if it's a new trip.
+
+    Either way it's one statement: an INSERT for a new trip, otherwise an
+    UPDATE that checks the permissions itself and never reads the old
+    trip_data.
     """
 
     with session_scope() as session:
-        trip = None
-        if trip_id:
-            trip = session.query(Trip).filter_by(id=trip_id).one_or_none()
-
-        if trip:
-            # Check if authenticated user is allowed to edit
-            if (trip.owner != authenticated_user and authenticated_user not in trip.editors):
+        # If we don't have a trip_id, create a new trip. The frontend
+        # cannot choose the trip id.
+        if not trip_id:
+            trip_id = uuid.uuid4()
+            session.execute(insert(Trip).values(
+                id=trip_id,
+                owner=authenticated_user,
+                name=trip_name,
+                viewers=view if view is not None else [],
+                editors=edit if edit is not None else [],
+                trip_data=trip_data,
+                version=1))
+            return trip_id
+
+        saved = session.execute(
+            save_trip_statement(authenticated_user, trip_id, trip_name, trip_data, view, edit)
+        ).scalar_one_or_none()
+        if saved is None:
+            # Nothing was written; only now is it worth finding out why
+            if trip_exists(session, trip_id):
                 raise PermissionError("Authenticated user does not have permission to edit this trip.")
+            raise PermissionError("Invalid trip ID")
+        return saved
+
+def save_trip_statement(authenticated_user, trip_id, trip_name=None, trip_data=None, view=None, edit=None):
+    # editor and owner can both change trip_data and name; only the
+    # owner can update editors and viewers (an editor's are ignored)
+    values = {"version": Trip.version + 1, "updated_at": func.now()}
+    if trip_name is not None:
+        values["name"] = trip_name
+    if trip_data is not None:
+        values["trip_data"] = trip_data
+    is_owner = Trip.owner == authenticated_user
+    if view is not None:
+        values["viewers"] = case((is_owner, cast(view, ARRAY(Text))), else_=Trip.viewers)
+    if edit is not None:
+        values["editors"] = case((is_owner, cast(edit, ARRAY(Text))), else_=Trip.editors)
+    return (
+        update(Trip)
+        .where(Trip.id == trip_id, can_edit(authenticated_user))
+        .values(values)
+        .returning(Trip.id)
+        .execution_options(synchronize_session=False))
+
+@metrics.instrumented
+def db_patch_trip(authenticated_user, trip_id, patch, expected_version):
+    """
+    Applies a JSON Patch (RFC 6902) to a trip's trip_data inside
+    Postgres, if the trip is still at expected_version.
 
-            # Only owner can update editors and viewers
-            if trip.owner == authenticated_user:
-              trip.viewers = view if view is not None else trip.viewers
-              trip.editors = edit if edit is not None else trip.editors
-
-            # editor and owner can both change trip_data and name
-            trip.name = trip_name if trip_name is not None else trip.name
-            trip.trip_data = trip_data if trip_data is not None else trip.trip_data
-
-        # frontend cannot choose the trip id
-        if not trip and trip_id:
-          raise PermissionError("Invalid trip ID")
-
-        # If no trip is found and we don't have a trip_id, create a
-        # new one
-        if not trip and not trip_id:
-            trip = Trip(owner=authenticated_user,
-                        name=trip_name,
-                        viewers=view,
-                        editors=edit,
-                        trip_data=trip_data,
-                        id = uuid.uuid4())
+    Parameters:
+    - authenticated_user: The email of the authenticated user.
+    - trip_id: The ID of the trip.
+    - patch: List of JSON Patch operations.
+    - expected_version: The trip version the patch was made against.
 
-        session.add(trip)
-        return trip.id
+    Returns:
+    - The new version of the trip.
 
-def db_get_trip(authenticated_user, trip_id):
+    Raises PatchError if the patch is invalid or doesn't apply, and
+    VersionConflictError if the trip is no longer at expected_version.
+    """
+    operations = json_patch.validate(patch)
+    with session_scope() as session:
+        result = json_patch.patched(
+            Trip.trip_data, operations,
+            and_(Trip.id == trip_id,
+                 Trip.version == expected_version,
+                 can_edit(authenticated_user)))
+        # The version is checked again by the UPDATE itself, in case
+        # another save committed while this one was running.
+        statement = (
+            update(Trip)
+            .where(Trip.id == trip_id, Trip.version == expected_version, result.c.ok)
+            .values(trip_data=result.c.doc, version=Trip.version + 1, updated_at=func.now())
+            .returning(Trip.version)
+            .execution_options(synchronize_session=False))
+        try:
+            new_version = session.execute(statement).scalar_one_or_none()
+        except DataError as e:
+            # The transaction is aborted; the request's other work is
+            # lost with it, like with any failed statement
+            session.rollback()
+            raise PatchError(f"The patch could not be applied: {e.orig}")
+        if new_version is not None:
+            return new_version
+
+        # Nothing was written; find out why.
+        row = (
+            session.query(Trip.version, can_edit(authenticated_user).label("can_edit"))
+            .filter(Trip.id == trip_id)
+            .one_or_none())
+        if row is None:
+            raise ValueError("Trip not found.")
+        if not row.can_edit:
+            raise PermissionError("Authenticated user does not have permission to edit this trip.")
+        if row.version != expected_version:
+            raise VersionConflictError(row.version)
+        raise PatchError("The patch could not be applied: a test failed or a path does not exist.")
+
+@metrics.instrumented
+def db_get_trip_json(authenticated_user, trip_id):
     """
-    Retrieves the trip data structure from the database.
+    Retrieves a trip's data structure, if the authenticated user has
+    permissions to view the trip, as JSON text rendered by Postgres
+    (trip_data::text) for passing straight to the response.
 
     Parameters:
     - authenticated_user: The email of the authenticated user.
     - trip_id: The ID of the trip.
 
     Returns:
-    - The JSON trip structure if the authenticated user has permissions to view the trip.
+    - A tuple (trip_json, version).
     """
+    with session_scope() as session:
+        row = session.execute(trip_json_query(authenticated_user, trip_id)).one_or_none()
+        if row is None:
+            if trip_exists(session, trip_id):
+                raise PermissionError("Authenticated user does not have permission to view this trip.")
+            raise ValueError("Trip not found.")
+        trip_json = row.trip_json if row.trip_json is not None else "null"
+        return trip_json, row.version
 
+@metrics.instrumented
+def db_get_trip_version(authenticated_user, trip_id):
+    """
+    Retrieves only the version of a trip (see Trip.version), without
+    reading trip_data, if the authenticated user can view the trip.
+    """
     with session_scope() as session:
-        trip = session.query(Trip).filter_by(id=trip_id).one_or_none()
-
-        # check permissions
-        if trip:
-            if (
-                trip.owner == authenticated_user or
-                authenticated_user in trip.editors or
-                authenticated_user in trip.viewers
-            ):
-                return trip.trip_data
-            else:
+        row = session.execute(trip_version_query(authenticated_user, trip_id)).one_or_none()
+        if row is None:
+            if trip_exists(session, trip_id):
                 raise PermissionError("Authenticated user does not have permission to view this trip.")
-        else:
             raise ValueError("Trip not found.")
+        return row.version
 
+@metrics.instrumented
 def db_save_preferences(user, data):
   with session_scope() as session:
-    preference = session.query(Preference).filter_by(email=user).one_or_none()
-    if preference is None:
-      preference = Preference(email=user, preferences_data=data)
-      session.add(preference)
-    else:
-      preference.preferences_data = data
+    session.execute(save_preferences_statement(user, data))
+
+# One upsert instead of SELECT then INSERT or UPDATE
+def save_preferences_statement(user, data):
+  statement = insert(Preference).values(email=user, preferences_data=data)
+  return statement.on_conflict_do_update(
+      index_elements=[Preference.email],
+      set_={"preferences_data": statement.excluded.preferences_data})
 
+@metrics.instrumented
 def db_get_preferences(user):
   with session_scope() as session:
-    preference = session.query(Preference).filter_by(email=user).one_or_none()
-    if preference is not None:
-        return preference.preferences_data
-    else:
-        return None
+    return session.execute(preferences_query(user)).scalar_one_or_none()
 
 # "userinfo" is simply some json data about the user that we get from
 # the Auth0 API. Since there is a rate limit, we need to cache it
 # after retrieving it for the first time for a token.
+@metrics.instrumented
 def db_cache_userinfo(token, data):
     """
-    Adds a new record to the 'userinfo' table.
+    Adds (or replaces) the record for token in the 'userinfo' table.
 
     Parameters:
     - token: The authentication token for the user.
     - data: The JSON data representing the user's information.
     """
     with session_scope() as session:
-        user_info = UserInfo(token=token, data=data)
-        session.add(user_info)
+        session.execute(cache_userinfo_statement(token, data))
+
+# Upsert, so two requests caching the same token don't fail on the
+# primary key; the later response wins and restarts the TTL.
+def cache_userinfo_statement(token, data):
+    statement = insert(UserInfo).values(token=token, data=data)
+    return statement.on_conflict_do_update(
+        index_elements=[UserInfo.token],
+        set_={"data": statement.excluded.data, "created_at": func.now()})
 
 # Check for, and return, cached userinfo for a token. Tokens expire
-# after 10 hours, so we also clear old cache data here.
+# after 10 hours (config.userinfo_ttl), so older records are ignored
+# here and deleted later by db_purge_userinfo.
+@metrics.instrumented
 def db_check_userinfo(token):
   with session_scope() as session:
-    # Delete records older than 10 hours
-    threshold_time = datetime.now(timezone.utc) - timedelta(hours=10)
-    session.query(UserInfo).filter(UserInfo.created_at < threshold_time).delete()
-
-    # Check for userinfo
-    userinfo = session.query(UserInfo).filter_by(token=token).one_or_none()
-    if userinfo is not None:
-        return userinfo.data
-    else:
-        return None
+    return session.execute(userinfo_query(token)).scalar_one_or_none()
+
+# Arbitrary key for pg_try_advisory_lock, so only one instance at a
+# time purges the userinfo table.
+USERINFO_SWEEP_LOCK = 7_210_001
+
+@metrics.instrumented
+def db_purge_userinfo(batch_size=1000):
+    """
+    Deletes userinfo records older than config.userinfo_ttl, batch_size
+    rows per transaction so the table is never locked for long. Uses
+    the idx_userinfo_created_at index.
+
+    Returns:
+    - The number of rows deleted, or None if another instance holds the
+      sweep lock.
+    """
+    threshold_time = cutoff(userinfo_ttl)
+    if db_pgbouncer:
+        return _purge_userinfo_xact_locked(threshold_time, batch_size)
+    purged = 0
+    # Advisory locks belong to the connection, so lock, delete and
+    # unlock all happen on the same one.
+    with get_engine().connect() as conn:
+        locked = conn.execute(select(func.pg_try_advisory_lock(USERINFO_SWEEP_LOCK))).scalar()
+        conn.commit()
+        if not locked:
+            return None
+        try:
+            while True:
+                result = conn.execute(delete_expired_userinfo(threshold_time, batch_size))
+                conn.commit()
+                purged += result.rowcount
+                if result.rowcount < batch_size:
+                    break
+        finally:
+            conn.rollback()
+            conn.execute(select(func.pg_advisory_unlock(USERINFO_SWEEP_LOCK)))
+            conn.commit()
+    return purged
+
+def _purge_userinfo_xact_locked(threshold_time, batch_size):
+    # Behind PgBouncer's transaction pooling each transaction can run on a
+    # different server connection, so a session lock could be taken on one
+    # and never released. Each batch takes a transaction-level lock
+    # instead, released by its own commit.
+    purged = 0
+    with get_engine().connect() as conn:
+        while True:
+            with conn.begin():
+                locked = conn.execute(select(func.pg_try_advisory_xact_lock(USERINFO_SWEEP_LOCK))).scalar()
+                if not locked:
+                    # Another instance is sweeping
+                    return purged or None
+                result = conn.execute(delete_expired_userinfo(threshold_time, batch_size))
+            purged += result.rowcount
+            if result.rowcount < batch_size:
+                return purged
+
+def delete_expired_userinfo(threshold_time, batch_size):
+    expired = (
+        select(UserInfo.token)
+        .where(UserInfo.created_at < threshold_time)
+        .limit(batch_size))
+    return delete(UserInfo).where(UserInfo.token.in_(expired))
+
+@metrics.instrumented
+def db_get_cached_types(terms, max_age):
+    """
+    Returns a dict of term -> list of Places types for the terms that
+    have a cached LLM answer younger than max_age seconds.
+    """
+    with session_scope() as session:
+        rows = session.execute(cached_types_query(terms, max_age)).all()
+        return {row.term: row.types for row in rows}
+
+def cached_types_query(terms, max_age):
+    threshold_time = cutoff(max_age)
+    return (
+        select(PreferenceTypes.term, PreferenceTypes.types)
+        .where(PreferenceTypes.term.in_(terms),
+               PreferenceTypes.created_at >= threshold_time))
+
+@metrics.instrumented
+def db_cache_types(matches):
+    """
+    Stores LLM answers (dict of term -> list of Places types),
+    replacing older answers for the same terms.
+    """
+    if not matches:
+        return
+    with session_scope() as session:
+        session.execute(cache_types_statement(matches))
+
+def cache_types_statement(matches):
+    statement = insert(PreferenceTypes).values(
+        [{"term": term, "types": types} for term, types in matches.items()])
+    return statement.on_conflict_do_update(
+        index_elements=[PreferenceTypes.term],
+        set_={"types": statement.excluded.types, "created_at": func.now()})
 
+@metrics.instrumented
 def db_delete_trip(authenticated_user, trip_id):
     """
     Deletes a trip if the authenticated user is the owner.
@@ -228,16 +743,17 @@ def db_delete_trip(authenticated_user, trip_id):
     - trip_id: The ID of the trip to be deleted.
     """
     with session_scope() as session:
-        trip = session.query(Trip).filter_by(id=trip_id).one_or_none()
-        if trip:
-            if trip.owner == authenticated_user:
-                session.delete(trip)
-            else:
+        deleted = (
+            session.query(Trip)
+            .filter(Trip.id == trip_id, Trip.owner == authenticated_user)
+            .delete(synchronize_session=False))
+        if not deleted:
+            if trip_exists(session, trip_id):
                 raise PermissionError("Authenticated user does not have permission to delete this trip.")
-        else:
             raise ValueError("Trip not found.")
 
 
+@metrics.instrumented
 def db_get_trip_name(authenticated_user, trip_id):
     """
     Retrieves the name of the trip if the authenticated user has permission.
@@ -250,20 +766,18 @@ def db_get_trip_name(authenticated_user, trip_id):
     - The name of the trip.
     """
     with session_scope() as session:
-        trip = session.query(Trip).filter_by(id=trip_id).one_or_none()
-        if trip:
-            if (
-                trip.owner == authenticated_user or
-                authenticated_user in trip.viewers or
-                authenticated_user in trip.editors
-            ):
-                return trip.name
-            else:
+        row = (
+            session.query(Trip.name)
+            .filter(Trip.id == trip_id, can_view(authenticated_user))
+            .one_or_none())
+        if row is None:
+            if trip_exists(session, trip_id):
                 raise PermissionError("Authenticated user does not have permission to view the trip name.")
-        else:
             raise ValueError("Trip not found.")
+        return row.name
 
 
+@metrics.instrumented
 def db_get_viewers(authenticated_user, trip_id):
     """
     Retrieves the list of viewers for a trip if the authenticated user is the owner.
@@ -276,16 +790,18 @@ def db_get_viewers(authenticated_user, trip_id):
     - List of viewers' emails.
     """
     with session_scope() as session:
-        trip = session.query(Trip).filter_by(id=trip_id).one_or_none()
-        if trip:
-            if trip.owner == authenticated_user:
-                return trip.viewers
-            else:
+        row = (
+            session.query(Trip.viewers)
+            .filter(Trip.id == trip_id, Trip.owner == authenticated_user)
+            .one_or_none())
+        if row is None:
+            if trip_exists(session, trip_id):
                 raise PermissionError("Authenticated user does not have permission to view trip viewers.")
-        else:
             raise ValueError("Trip not found.")
+        return row.viewers
 
 
+@metrics.instrumented
 def db_get_editors(authenticated_user, trip_id):
     """
     Retrieves the list of editors for a trip if the authenticated user is the owner.
@@ -298,15 +814,72 @@ def db_get_editors(authenticated_user, trip_id):
     - List of editors' emails.
     """
     with session_scope() as session:
-        trip = session.query(Trip).filter_by(id=trip_id).one_or_none()
-        if trip:
-            if trip.owner == authenticated_user:
-                return trip.editors
-            else:
+        row = (
+            session.query(Trip.editors)
+            .filter(Trip.id == trip_id, Trip.owner == authenticated_user)
+            .one_or_none())
+        if row is None:
+            if trip_exists(session, trip_id):
                 raise PermissionError("Authenticated user does not have permission to view trip editors.")
-        else:
             raise ValueError("Trip not found.")
+        return row.editors
+
+@metrics.instrumented
+def db_get_trips_metadata(authenticated_user, trip_ids):
+    """
+    Retrieves the name and permissions of several trips in one query,
+    with the same rules as db_get_trip_name, db_is_owner, db_can_edit,
+    db_get_viewers and db_get_editors.
 
+    Parameters:
+    - authenticated_user: The email of the authenticated user.
+    - trip_ids: List of trip IDs.
+
+    Returns:
+    - A dict of trip_id -> metadata. Viewers and editors are None unless
+      the authenticated user is the owner. Trips that don't exist or
+      that the user can't view map to {"error": ...}.
+    """
+    result = {}
+    valid_ids = {}
+    for trip_id in trip_ids:
+        try:
+            valid_ids[uuid.UUID(trip_id)] = trip_id
+        except ValueError:
+            result[trip_id] = {"error": "Trip not found."}
+
+    if valid_ids:
+        is_owner = Trip.owner == authenticated_user
+        with session_scope() as session:
+            rows = (
+                session.query(
+                    Trip.id,
+                    Trip.name,
+                    is_owner.label("is_owner"),
+                    can_edit(authenticated_user).label("can_edit"),
+                    can_view(authenticated_user).label("can_view"),
+                    case((is_owner, Trip.viewers)).label("viewers"),
+                    case((is_owner, Trip.editors)).label("editors"))
+                .filter(Trip.id.in_(list(valid_ids)))
+                .all())
+        found = {row.id: row for row in rows}
+        for trip_uuid, trip_id in valid_ids.items():
+            row = found.get(trip_uuid)
+            if row is None:
+                result[trip_id] = {"error": "Trip not found."}
+            elif not row.can_view:
+                result[trip_id] = {"error": "Authenticated user does not have permission to view this trip."}
+            else:
+                result[trip_id] = {
+                    "trip_name": row.name,
+                    "is_owner": row.is_owner,
+                    "can_edit": row.can_edit,
+                    "viewers": row.viewers,
+                    "editors": row.editors,
+                }
+    return result
+
+@metrics.instrumented
 def db_is_owner(authenticated_user, trip_id):
     """
     Returns true if the authenticated user is the trip owner.
@@ -316,13 +889,11 @@ def db_is_owner(authenticated_user, trip_id):
     - trip_id: The ID of the trip.
     """
     with session_scope() as session:
-        trip = session.query(Trip).filter_by(id=trip_id).one_or_none()
-        if trip:
-            if trip.owner == authenticated_user:
-              return True;
-            else:
-              return False;
+        return session.query(
+            exists().where(Trip.id == trip_id, Trip.owner == authenticated_user)
+        ).scalar()
 
+@metrics.instrumented
 def db_can_edit(authenticated_user, trip_id):
     """
     Returns true if the authenticated user has permissions to edit the trip.
@@ -332,9 +903,6 @@ def db_can_edit(authenticated_user, trip_id):
     - trip_id: The ID of the trip.
     """
     with session_scope() as session:
-        trip = session.query(Trip).filter_by(id=trip_id).one_or_none()
-        if trip:
-            if trip.owner == authenticated_user or authenticated_user in trip.editors:
-              return True;
-            else:
-              return False;
+        return session.query(
+            exists().where(Trip.id == trip_id, can_edit(authenticated_user))
+        ).scalar()
@@ -1,20 +1,143 @@
-from google.cloud import secretmanager
+# Access to our secrets (API keys, database credentials).
+#
+# Secrets live in Google Secret Manager, but every call to it is a
+# blocking gRPC round trip, so values are cached in memory with a
+# per-secret TTL and refreshed in the background before they expire.
+# Use prefetch() to load several secrets concurrently at startup.
+#
+# Set SECRETS_BACKEND=local to read secrets from environment variables
+# (SECRET_<NAME>, e.g. SECRET_DB_IP) or the JSON file SECRETS_FILE
+# instead, e.g. for tests or running without GCP credentials.
 
+import json
+import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from config import environment, gcloud_project_id
+from config import environment, gcloud_project_id, secrets_backend, secrets_file, secret_cache_ttl
+import metrics
 
-# Create the Secret Manager client.
-client = secretmanager.SecretManagerServiceClient()
+logger = logging.getLogger(__name__)
 
-def get_secret(name:str) -> str:
+# The Secret Manager client is created on first use; importing the
+# library and opening the channel is slow.
+client = None
+_client_lock = threading.Lock()
+
+# name -> (value, fetched_at, ttl)
+_cache = {}
+_cache_lock = threading.Lock()
+# names currently being refreshed in the background
+_refreshing = set()
+
+
+def _gcp_client():
+    global client
+    with _client_lock:
+        if client is None:
+            from google.cloud import secretmanager
+            client = secretmanager.SecretManagerServiceClient()
+    return client
+
+
+def _access_gcp(name:str) -> str:
     # ID of the secret to create.
     secret_id = name + "-" + environment
 
     name = f"projects/{gcloud_project_id}/secrets/{secret_id}/versions/latest"
 
     # Access the secret version
-    response = client.access_secret_version(request={"name": name})
+    response = _gcp_client().access_secret_version(request={"name": name})
 
     # Decoding the secret payload
     return response.payload.data.decode("UTF-8")
+
+
+def _access_local(name:str) -> str:
+    value = os.environ.get("SECRET_" + name.upper())
+    if value is not None:
+        return value
+    if os.path.exists(secrets_file):
+        with open(secrets_file) as f:
+            secrets = json.load(f)
+        if name in secrets:
+            return secrets[name]
+    raise KeyError(f"Secret {name} is not set in the environment or {secrets_file}")
+
+
+def access_secret(name:str) -> str:
+    """
+    Fetches the current value of a secret from the configured backend,
+    bypassing the cache.
+    """
+    if secrets_backend == "local":
+        return _access_local(name)
+    return _access_gcp(name)
+
+
+def _store(name, value, ttl):
+    with _cache_lock:
+        _cache[name] = (value, time.monotonic(), ttl)
+    return value
+
+
+def _refresh_in_background(name, ttl):
+    with _cache_lock:
+        if name in _refreshing:
+            return
+        _refreshing.add(name)
+
+    def refresh():
+        try:
+            _store(name, access_secret(name), ttl)
+        except Exception:
+            logger.warning("Refreshing secret %s failed, keeping cached value", name, exc_info=True)
+        finally:
+            with _cache_lock:
+                _refreshing.discard(name)
+
+    threading.Thread(target=refresh, name=f"secret-refresh-{name}", daemon=True).start()
+
+
+@metrics.instrumented
+def get_secret(name:str, ttl=None) -> str:
+    """
+    Returns the value of a secret, from memory when possible.
+
+    Parameters:
+    - name: Secret name without the environment suffix, e.g. "maps_api_key".
+    - ttl: (Optional) Seconds to cache this secret; defaults to config.secret_cache_ttl.
+
+    Once 80% of the TTL has passed the value is refreshed in the
+    background. Past the TTL the caller waits for a refresh, but the old
+    value is still returned if Secret Manager can't be reached.
+    """
+    ttl = secret_cache_ttl if ttl is None else ttl
+    cached = _cache.get(name)
+    if cached is None:
+        return _store(name, access_secret(name), ttl)
+
+    value, fetched_at, _ = cached
+    age = time.monotonic() - fetched_at
+    if age >= ttl:
+        try:
+            return _store(name, access_secret(name), ttl)
+        except Exception:
+            logger.warning("Refreshing secret %s failed, using cached value", name, exc_info=True)
+            return value
+    if age >= ttl * 0.8:
+        _refresh_in_background(name, ttl)
+    return value
+
+
+def prefetch(names, ttl=None):
+    """
+    Loads several secrets into the cache concurrently. Returns a dict of
+    name -> value.
+    """
+    names = list(names)
+    with ThreadPoolExecutor(max_workers=max(1, len(names))) as pool:
+        values = pool.map(lambda name: get_secret(name, ttl), names)
+        return dict(zip(names, values))
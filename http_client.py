@@ -0,0 +1,173 @@
+# Shared outbound HTTP client. Calls to Auth0 (JWKS, /userinfo) and
+# OpenAI all go through one pooled httpx client per process (plus an
+# async one for the ASGI mode), so connections are kept alive and TLS
+# handshakes are paid once per host rather than once per call.
+#
+# The transports record, per host, how many requests were made, how
+# long they took (until the response headers arrived) and how many of
+# them had to open a new connection; see stats().
+
+import logging
+import threading
+import time
+
+import httpx
+
+import metrics
+from config import (http_max_connections, http_max_keepalive, http_keepalive_expiry,
+                    http_connect_timeout, http_read_timeout, http2)
+
+logger = logging.getLogger(__name__)
+
+
+class HostStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.new_connections = 0
+        self.seconds_total = 0.0
+        self.seconds_max = 0.0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "new_connections": self.new_connections,
+            "reused_connections": max(0, self.requests - self.errors - self.new_connections),
+            "seconds_avg": round(self.seconds_total / self.requests, 6) if self.requests else 0.0,
+            "seconds_max": round(self.seconds_max, 6),
+        }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def record(host, seconds, new_connection, error):
+    metrics.record(f"http_{host}", seconds)
+    with _stats_lock:
+        stats = _stats.get(host)
+        if stats is None:
+            stats = _stats[host] = HostStats()
+        stats.requests += 1
+        stats.errors += error
+        stats.new_connections += new_connection
+        stats.seconds_total += seconds
+        stats.seconds_max = max(stats.seconds_max, seconds)
+
+
+def stats():
+    """
+    Returns a dict of host -> request count, latency and connection reuse.
+    """
+    with _stats_lock:
+        return {host: host_stats.as_dict() for host, host_stats in _stats.items()}
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+# httpcore reports each step of a request to the "trace" extension;
+# opening a TCP connection means the pool had no idle one for the host.
+NEW_CONNECTION_EVENT = "connection.connect_tcp.complete"
+
+
+class InstrumentedTransport(httpx.HTTPTransport):
+
+    def handle_request(self, request):
+        new_connection = []
+
+        def trace(event, info):
+            if event == NEW_CONNECTION_EVENT:
+                new_connection.append(True)
+
+        request.extensions["trace"] = trace
+        start = time.perf_counter()
+        error = True
+        try:
+            response = super().handle_request(request)
+            error = False
+            return response
+        finally:
+            record(request.url.host, time.perf_counter() - start, bool(new_connection), error)
+
+
+class InstrumentedAsyncTransport(httpx.AsyncHTTPTransport):
+
+    async def handle_async_request(self, request):
+        new_connection = []
+
+        async def trace(event, info):
+            if event == NEW_CONNECTION_EVENT:
+                new_connection.append(True)
+
+        request.extensions["trace"] = trace
+        start = time.perf_counter()
+        error = True
+        try:
+            response = await super().handle_async_request(request)
+            error = False
+            return response
+        finally:
+            record(request.url.host, time.perf_counter() - start, bool(new_connection), error)
+
+
+def use_http2():
+    if not http2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("HTTP2 is set but the h2 package isn't installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def client_options():
+    limits = httpx.Limits(max_connections=http_max_connections,
+                          max_keepalive_connections=http_max_keepalive,
+                          keepalive_expiry=http_keepalive_expiry)
+    timeout = httpx.Timeout(http_read_timeout, connect=http_connect_timeout)
+    return {"limits": limits, "http2": use_http2()}, timeout
+
+
+# Both clients are created on first use
+client = None
+async_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the shared httpx.Client.
+    """
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                transport_options, timeout = client_options()
+                client = httpx.Client(transport=InstrumentedTransport(**transport_options),
+                                      timeout=timeout)
+    return client
+
+
+def get_async_client():
+    """
+    Returns the shared httpx.AsyncClient, for the ASGI mode.
+    """
+    global async_client
+    if async_client is None:
+        transport_options, timeout = client_options()
+        async_client = httpx.AsyncClient(transport=InstrumentedAsyncTransport(**transport_options),
+                                         timeout=timeout)
+    return async_client
+
+
+async def aclose():
+    global async_client
+    if async_client is not None:
+        await async_client.aclose()
+        async_client = None
@@ -0,0 +1,192 @@
+# RFC 6902 JSON Patch, applied by Postgres.
+#
+# Instead of loading trip_data, patching it in Python and writing the
+# whole document back, each patch operation is translated into jsonb
+# functions (jsonb_set, jsonb_insert, #-, #>) so the document never
+# leaves the database. Operations are chained as CTEs, one per
+# operation, each working on the previous one's result. Every CTE also
+# carries an "ok" flag that becomes false if an operation's
+# precondition fails (a "test" that doesn't match, a path that doesn't
+# exist), in which case nothing is written.
+#
+# https://datatracker.ietf.org/doc/html/rfc6902
+
+import re
+
+from sqlalchemy import Text, and_, bindparam, case, cast, func, literal, select, true
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+
+OPS = ("add", "remove", "replace", "move", "copy", "test")
+
+# Longest patch accepted in one request
+MAX_OPERATIONS = 500
+
+# Array index in a JSON Pointer (RFC 6901): no sign, no leading zeros
+ARRAY_INDEX = re.compile(r"^(0|[1-9][0-9]*)$")
+
+
+class PatchError(Exception):
+    """
+    The patch is malformed or can't be applied to the document.
+    """
+
+
+def parse_pointer(pointer):
+    """
+    Splits a JSON Pointer (RFC 6901) such as "/days/0/name" into a list
+    of path elements, which is also the form Postgres' jsonb path
+    functions take.
+    """
+    if not isinstance(pointer, str):
+        raise PatchError(f"Invalid JSON pointer: {pointer!r}")
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise PatchError(f"JSON pointer must start with '/': {pointer!r}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def validate(patch):
+    """
+    Checks the structure of a patch document and returns it as a list
+    of (op, path, from_path, value) tuples with parsed paths.
+    """
+    if not isinstance(patch, list):
+        raise PatchError("A JSON Patch must be a list of operations.")
+    if len(patch) > MAX_OPERATIONS:
+        raise PatchError(f"A JSON Patch can have at most {MAX_OPERATIONS} operations.")
+    operations = []
+    for operation in patch:
+        if not isinstance(operation, dict) or operation.get("op") not in OPS:
+            raise PatchError(f"Invalid operation: {operation!r}")
+        op = operation["op"]
+        if "path" not in operation:
+            raise PatchError(f"Operation is missing 'path': {operation!r}")
+        path = parse_pointer(operation["path"])
+        from_path = None
+        if op in ("move", "copy"):
+            if "from" not in operation:
+                raise PatchError(f"Operation is missing 'from': {operation!r}")
+            from_path = parse_pointer(operation["from"])
+            if op == "move" and path[:len(from_path)] == from_path and path != from_path:
+                raise PatchError("Cannot move a value into one of its children.")
+        if op == "remove" and not path:
+            raise PatchError("Cannot remove the whole document.")
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise PatchError(f"Operation is missing 'value': {operation!r}")
+        if "-" in path[:-1] or (path[-1:] == ["-"] and op != "add"):
+            raise PatchError(f"'-' can only end the path of an add: {operation!r}")
+        operations.append((op, path, from_path, operation.get("value")))
+    return operations
+
+
+def _path(path):
+    return cast(bindparam(None, path, type_=ARRAY(Text)), ARRAY(Text))
+
+
+def _value(value):
+    return cast(bindparam(None, value, type_=JSONB), JSONB)
+
+
+def _get(doc, path):
+    return doc.op("#>", return_type=JSONB)(_path(path))
+
+
+def _exists(doc, path):
+    return and_(_get(doc, path).isnot(None), _indexes(doc, path))
+
+
+def _indexes(doc, path):
+    """
+    Precondition that every step of path into an array is an RFC 6901
+    index. Postgres' path functions also accept "-1" or "01", counting
+    negative indices from the end.
+    """
+    checks = [func.jsonb_typeof(_get(doc, path[:i])) != "array"
+              for i, token in enumerate(path) if not ARRAY_INDEX.match(token)]
+    return and_(*checks) if checks else true()
+
+
+def _add(doc, path, value):
+    """
+    Returns (new_doc, precondition) for adding value at path: insert
+    into arrays, set (or overwrite) object members.
+    """
+    if not path:
+        return value, true()
+    parent, last = path[:-1], path[-1]
+    parent_type = func.jsonb_typeof(_get(doc, parent))
+    parent_ok = _indexes(doc, parent)
+    if last == "-":
+        appended = func.jsonb_insert(doc, _path(parent + ["-1"]), value, True, type_=JSONB)
+        # jsonb_insert can't append to an empty array, and jsonb_set
+        # can't replace the whole document
+        filled = func.jsonb_build_array(value)
+        if parent:
+            filled = func.jsonb_set(doc, _path(parent), filled, type_=JSONB)
+        appended = case((_get(doc, parent) == cast("[]", JSONB), filled), else_=appended)
+        return appended, and_(parent_ok, parent_type == "array")
+    if not ARRAY_INDEX.match(last):
+        # Not an array index; only valid for an object member
+        return (func.jsonb_set(doc, _path(path), value, True, type_=JSONB),
+                and_(parent_ok, parent_type == "object"))
+    # jsonb_insert appends past the end and counts negative indices
+    # from the end; RFC 6902 only allows 0 up to the array's length
+    new_doc = case(
+        (parent_type == "array", func.jsonb_insert(doc, _path(path), value, type_=JSONB)),
+        else_=func.jsonb_set(doc, _path(path), value, True, type_=JSONB))
+    in_range = func.jsonb_array_length(_get(doc, parent)) >= int(last)
+    return new_doc, and_(parent_ok, case((parent_type == "array", in_range), else_=parent_type == "object"))
+
+
+def _remove(doc, path):
+    return doc.op("#-", return_type=JSONB)(_path(path))
+
+
+def _step(doc, op, path, from_path, value):
+    """
+    Returns (new_doc, precondition) for one operation.
+    """
+    if op == "add":
+        return _add(doc, path, _value(value))
+    if op == "remove":
+        return _remove(doc, path), _exists(doc, path)
+    if op == "replace":
+        if not path:
+            return _value(value), true()
+        return func.jsonb_set(doc, _path(path), _value(value), False, type_=JSONB), _exists(doc, path)
+    if op == "test":
+        return doc, and_(_indexes(doc, path), _get(doc, path) == _value(value))
+    moved = _get(doc, from_path)
+    if op == "copy":
+        new_doc, ok = _add(doc, path, moved)
+        return new_doc, and_(_exists(doc, from_path), ok)
+    # move
+    if path == from_path:
+        return doc, _exists(doc, from_path)
+    new_doc, ok = _add(_remove(doc, from_path), path, moved)
+    return new_doc, and_(_exists(doc, from_path), ok)
+
+
+def patched(document, patch, whereclause):
+    """
+    Returns a CTE with one row and columns "doc" (the patched document)
+    and "ok" (whether every operation could be applied).
+
+    Parameters:
+    - document: The jsonb column to patch, e.g. Trip.trip_data.
+    - patch: The validated patch, see validate().
+    - whereclause: Selects the single row to patch.
+    """
+    step = (
+        select(document.label("doc"), literal(True).label("ok"))
+        .where(whereclause)
+        .cte("patch_0"))
+    for i, (op, path, from_path, value) in enumerate(patch, 1):
+        doc, ok = _step(step.c.doc, op, path, from_path, value)
+        step = select(
+            doc.label("doc"),
+            and_(step.c.ok, func.coalesce(ok, False)).label("ok")
+        ).cte(f"patch_{i}")
+    return step
+
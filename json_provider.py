@@ -0,0 +1,43 @@
+# Faster JSON for Flask. When orjson is installed it replaces Flask's
+# json module for jsonify() and request.json; orjson serializes UUIDs
+# and datetimes natively and is several times faster on large trip
+# documents. Without orjson Flask's default provider is used.
+
+from flask.json.provider import DefaultJSONProvider
+
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    # OPT_NON_STR_KEYS: like json.dumps, allow e.g. UUID or int keys
+    # OPT_SORT_KEYS: same output as Flask's default provider
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self.option | orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        with metrics.timed("json"):
+            body = orjson.dumps(obj, default=self.default, option=option)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def init_app(app):
+    """
+    Installs the fastest available JSON provider on app.
+    """
+    if orjson is not None:
+        app.json = ORJSONProvider(app)
+    return app.json
@@ -0,0 +1,179 @@
+# In-process cache for the Auth0 JSON Web Key Set (JWKS).
+#
+# Auth0 rotates its signing keys very rarely, so there is no reason to
+# fetch https://<domain>/.well-known/jwks.json on every request. Keys
+# are cached by "kid" for the max-age Auth0 sends in Cache-Control (or
+# config.jwks_cache_ttl if it sends none), refreshed in the background
+# shortly before they expire, and refetched immediately when a token
+# arrives signed with a kid we haven't seen (key rotation).
+#
+# Only one thread ever talks to Auth0 at a time ("single-flight"): the
+# other gunicorn threads wait for that fetch instead of starting their
+# own. If a refresh fails we keep serving the last good key set.
+
+import logging
+import re
+import threading
+import time
+
+import http_client
+
+logger = logging.getLogger(__name__)
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+def parse_max_age(cache_control):
+    """
+    Returns the max-age from a Cache-Control header value in seconds,
+    0 for no-cache/no-store, or None if the header doesn't say.
+    """
+    if not cache_control:
+        return None
+    directives = cache_control.lower()
+    if "no-store" in directives or "no-cache" in directives:
+        return 0
+    match = _MAX_AGE.search(directives)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def fetch_jwks(url, timeout=5):
+    """
+    Downloads the key set. Returns a tuple (jwks, max_age) where max_age
+    is taken from the Cache-Control response header (may be None).
+    """
+    response = http_client.get_client().get(url, timeout=timeout)
+    response.raise_for_status()
+    max_age = parse_max_age(response.headers.get("Cache-Control"))
+    return response.json(), max_age
+
+
+class JWKSKeyStore:
+    """
+    Thread-safe cache of RSA signing keys indexed by kid.
+
+    Parameters:
+    - url: The JWKS url, e.g. https://<auth0_domain>/.well-known/jwks.json
+    - default_ttl: Seconds to cache the keys when Auth0 doesn't send a max-age.
+    - min_ttl / max_ttl: Bounds applied to the Cache-Control max-age.
+    - refresh_ahead: Fraction of the TTL after which a background refresh starts.
+    - miss_interval: Minimum seconds between refetches caused by unknown kids,
+      so garbage tokens can't be used to hammer Auth0.
+    - fetch: Callable(url) -> (jwks, max_age); defaults to fetch_jwks.
+    """
+
+    def __init__(self, url, default_ttl=600, min_ttl=60, max_ttl=86400,
+                 refresh_ahead=0.8, miss_interval=30, fetch=fetch_jwks):
+        self.url = url
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.refresh_ahead = refresh_ahead
+        self.miss_interval = miss_interval
+        self._fetch = fetch
+
+        self._keys = {}
+        self._fetched_at = None
+        self._expires_at = 0.0
+        self._last_attempt = None
+
+        self._cond = threading.Condition()
+        self._refreshing = False
+
+        self.fetches = 0
+        self.failures = 0
+
+    def get_key(self, kid):
+        """
+        Returns the RSA key dict for kid, or None if Auth0 doesn't have it.
+        """
+        now = time.monotonic()
+        if now >= self._expires_at:
+            # Expired (or never loaded): everybody needs fresh keys.
+            self._refresh(wait=True)
+        elif now >= self._refresh_at():
+            self._refresh(wait=False)
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch_on_miss():
+            self._refresh(wait=True)
+            key = self._keys.get(kid)
+        return key
+
+    def preload(self):
+        """
+        Fetches the key set now (e.g. while warming up an instance).
+        """
+        self._refresh(wait=True)
+
+    def _refresh_at(self):
+        ttl = self._expires_at - self._fetched_at
+        return self._fetched_at + ttl * self.refresh_ahead
+
+    def _may_refetch_on_miss(self):
+        last = self._last_attempt
+        return last is None or time.monotonic() - last >= self.miss_interval
+
+    def _refresh(self, wait):
+        """
+        Refetches the key set unless another thread already is. With
+        wait=True the caller blocks until the in-flight fetch is done;
+        otherwise the fetch runs on a background thread.
+        """
+        with self._cond:
+            if self._refreshing:
+                if wait:
+                    while self._refreshing:
+                        self._cond.wait()
+                return
+            self._refreshing = True
+
+        if wait:
+            self._do_refresh()
+        else:
+            threading.Thread(target=self._do_refresh, name="jwks-refresh", daemon=True).start()
+
+    def _do_refresh(self):
+        try:
+            self._last_attempt = time.monotonic()
+            self.fetches += 1
+            jwks, max_age = self._fetch(self.url)
+            keys = {}
+            for key in jwks["keys"]:
+                keys[key["kid"]] = {
+                    "kty": key["kty"],
+                    "kid": key["kid"],
+                    "use": key["use"],
+                    "n": key["n"],
+                    "e": key["e"]
+                }
+            ttl = self.default_ttl if max_age is None else max_age
+            ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+            now = time.monotonic()
+            self._keys = keys
+            self._fetched_at = now
+            self._expires_at = now + ttl
+        except Exception:
+            self.failures += 1
+            if self._keys:
+                # Keep the last good keys; try again after min_ttl.
+                now = time.monotonic()
+                self._fetched_at = now
+                self._expires_at = now + self.min_ttl
+                logger.warning("JWKS refresh failed, serving cached keys", exc_info=True)
+            else:
+                logger.error("JWKS fetch failed and no keys are cached", exc_info=True)
+        finally:
+            with self._cond:
+                self._refreshing = False
+                self._cond.notify_all()
+
+    def stats(self):
+        return {
+            "keys": len(self._keys),
+            "fetches": self.fetches,
+            "failures": self.failures,
+            "expires_in": max(0.0, self._expires_at - time.monotonic()),
+        }
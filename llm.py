@@ -1,6 +1,21 @@
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+
 from pydantic import BaseModel
-from openai import OpenAI
 from google_secrets import get_secret
+from cache import LRUCache
+from config import (llm_cache_size, llm_cache_ttl, type_match_threshold,
+                    openai_base_url, llm_max_concurrency, llm_timeout, llm_max_retries)
+from singleflight import SingleFlight, AsyncSingleFlight
+from type_matcher import TypeMatcher
+import database
+import http_client
+import metrics
+import startup
 
 # List of Places API types https://developers.google.com/maps/documentation/places/web-service/supported_types
 places_api_types = ["accounting", "airport", "amusement_park",
@@ -28,25 +43,353 @@ places_api_types = ["accounting", "airport", "amusement_park",
                     "transit_station", "travel_agency", "university",
                     "veterinary_care", "zoo"]
 
-# Initialize OpenAI client
-openai_api_key = get_secret("openai")
-client = OpenAI(api_key=openai_api_key)
+# The OpenAI client is created on first use (the openai package is
+# slow to import and needs a secret), see get_client.
+client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                with startup.timed("init openai client"):
+                    from openai import OpenAI
+                    # Retries are done by call_llm, within its deadline
+                    client = OpenAI(api_key=get_secret("openai"),
+                                    base_url=openai_base_url,
+                                    max_retries=0,
+                                    http_client=http_client.get_client())
+    return client
+
+
+# Client for the ASGI mode (asgi.py), also created on first use
+async_client = None
+
+
+async def get_async_client():
+    global async_client
+    if async_client is None:
+        # get_secret can block on Secret Manager
+        api_key = await asyncio.to_thread(get_secret, "openai")
+        if async_client is None:
+            from openai import AsyncOpenAI
+            async_client = AsyncOpenAI(api_key=api_key, base_url=openai_base_url, max_retries=0,
+                                       http_client=http_client.get_async_client())
+    return async_client
 
 
 class GooglePlacesTypeList(BaseModel):
     types: list[str]
 
 
-# Function to call the LLM API
-def match_to_places_api_types(input_list):
-    response = client.beta.chat.completions.parse(
+class TermTypes(BaseModel):
+    term: str
+    types: list[str]
+
+
+class TermTypesList(BaseModel):
+    matches: list[TermTypes]
+
+
+logger = logging.getLogger(__name__)
+
+valid_types = frozenset(places_api_types)
+
+# Resolves the easy terms ("zoo", "art galleries") without the LLM
+matcher = TypeMatcher(places_api_types, type_match_threshold)
+
+# Per-term results, first tier. The second tier is the
+# preference_types table, shared by all instances.
+type_cache = LRUCache(maxsize=llm_cache_size, ttl=llm_cache_ttl)
+
+
+def normalize_term(term):
+    return re.sub(r"\s+", " ", str(term)).strip().lower()
+
+
+def llm_request(terms):
+    """
+    Returns the arguments of the chat completion request for terms.
+    """
+    return dict(
         model="gpt-4o-mini",  # Use gpt-4o-mini model
         messages=[
             {"role": "system", "content":
-            f"Convert the input words or phrases into a list of all related Google Places \"types\" at a ratio of 1 input to 1 Google Place \"type\". Here are the valid \"types\": {places_api_types}"},
-            {"role": "user", "content": f"Input list: {input_list}"}
+            f"For each input word or phrase, list the related Google Places \"types\", usually 1 Google Place \"type\" per input. Return every input exactly as given in \"term\". Here are the valid \"types\": {places_api_types}"},
+            {"role": "user", "content": f"Input list: {terms}"}
         ],
-        response_format=GooglePlacesTypeList,
+        response_format=TermTypesList,
     )
 
-    return response.choices[0].message.parsed
+
+def parse_matches(response, terms):
+    """
+    Returns a dict of term -> list of valid types from the model's
+    response; terms the model skipped are missing.
+    """
+    wanted = set(terms)
+    matches = {}
+    for match in response.choices[0].message.parsed.matches:
+        term = normalize_term(match.term)
+        if term in wanted:
+            # The model can hallucinate types; never cache those.
+            matches[term] = [t for t in match.types if t in valid_types]
+    return matches
+
+
+def ask_llm(terms, timeout=None):
+    """
+    Asks the model for the Places types of each term. Returns a dict of
+    term -> list of valid types; terms the model skipped are missing.
+    """
+    llm_client = get_client()
+    if timeout is not None:
+        llm_client = llm_client.with_options(timeout=timeout)
+    return parse_matches(llm_client.beta.chat.completions.parse(**llm_request(terms)), terms)
+
+
+async def ask_llm_async(terms):
+    llm_client = await get_async_client()
+    return parse_matches(await llm_client.beta.chat.completions.parse(**llm_request(terms)), terms)
+
+
+# Execution layer for ask_llm. At most llm_max_concurrency calls run at
+# once, so a burst of preferences_to_types requests can't tie up every
+# gunicorn thread waiting on OpenAI. A call that finds every slot taken
+# waits at most LLM_SLOT_WAIT seconds for one instead of holding its
+# thread until the deadline. Each call has a deadline covering all
+# retries, identical requests in flight at the same time share one call,
+# and when there's no slot or the deadline is hit
+# match_to_places_api_types answers with what it has without the LLM.
+LLM_SLOT_WAIT = 0.1
+llm_slots = threading.BoundedSemaphore(llm_max_concurrency)
+in_flight = SingleFlight()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def is_retryable(error):
+    import openai
+    # APITimeoutError is an APIConnectionError
+    return isinstance(error, (openai.APIConnectionError,
+                              openai.RateLimitError,
+                              openai.InternalServerError))
+
+
+def retry_backoff(attempt):
+    # "Full jitter" exponential backoff
+    return random.uniform(0, min(2.0, 0.1 * 2 ** attempt))
+
+
+@metrics.instrumented
+def call_llm(terms, timeout=None):
+    """
+    Runs ask_llm(terms) within the concurrency limit, retrying transient
+    errors with jittered exponential backoff. Raises DeadlineExceeded if
+    no slot frees up within LLM_SLOT_WAIT seconds or it can't finish
+    within timeout seconds (config.llm_timeout).
+    """
+    timeout = llm_timeout if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    if not llm_slots.acquire(timeout=min(timeout, LLM_SLOT_WAIT)):
+        raise DeadlineExceeded("No free LLM slot")
+    try:
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded("LLM deadline exceeded")
+            try:
+                return ask_llm(terms, timeout=remaining)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                attempt += 1
+                if deadline - time.monotonic() <= 0:
+                    raise DeadlineExceeded("LLM deadline exceeded") from e
+                if attempt > llm_max_retries:
+                    raise
+                backoff = retry_backoff(attempt)
+                if time.monotonic() + backoff >= deadline:
+                    raise DeadlineExceeded("LLM deadline exceeded") from e
+                logger.info("Retrying LLM call in %.2fs after %r", backoff, e)
+                time.sleep(backoff)
+    finally:
+        llm_slots.release()
+
+
+# The asyncio versions, for the ASGI mode. The semaphore is created on
+# first use, inside the event loop.
+async_llm_slots = None
+async_in_flight = AsyncSingleFlight()
+
+
+@metrics.instrumented
+async def call_llm_async(terms, timeout=None):
+    """
+    Async version of call_llm.
+    """
+    global async_llm_slots
+    if async_llm_slots is None:
+        async_llm_slots = asyncio.Semaphore(llm_max_concurrency)
+    timeout = llm_timeout if timeout is None else timeout
+
+    async def call():
+        async with async_llm_slots:
+            attempt = 0
+            while True:
+                try:
+                    return await ask_llm_async(terms)
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                    attempt += 1
+                    if attempt > llm_max_retries:
+                        raise
+                    backoff = retry_backoff(attempt)
+                    logger.info("Retrying LLM call in %.2fs after %r", backoff, e)
+                    await asyncio.sleep(backoff)
+
+    try:
+        return await asyncio.wait_for(call(), timeout)
+    except asyncio.TimeoutError as e:
+        raise DeadlineExceeded("LLM deadline exceeded") from e
+
+
+def lookup_memory(terms):
+    """
+    Returns (found, missing): a dict of term -> types for the terms in
+    the memory tier, and the list of the other terms.
+    """
+    found = {}
+    missing = []
+    for term in terms:
+        types = type_cache.get(term)
+        if types is None:
+            missing.append(term)
+        else:
+            found[term] = types
+    return found, missing
+
+
+def lookup_types(terms):
+    """
+    Returns a dict of term -> types for the terms with a cached result,
+    checking memory first and then the database.
+    """
+    found, missing = lookup_memory(terms)
+    if missing:
+        # The database tier is only an optimization; don't fail the
+        # request if it's unavailable.
+        try:
+            cached = database.db_get_cached_types(missing, llm_cache_ttl)
+        except Exception:
+            logger.warning("Reading cached preference types failed", exc_info=True)
+            cached = {}
+        for term, types in cached.items():
+            type_cache.set(term, types)
+            found[term] = types
+    return found
+
+
+def prepare_terms(input_list):
+    terms = list(dict.fromkeys(normalize_term(term) for term in input_list))
+    return [term for term in terms if term]
+
+
+def match_locally(terms):
+    matches = {}
+    for term in terms:
+        types = matcher.match(term)
+        if types is not None:
+            matches[term] = types
+    return matches
+
+
+def cacheable(answers):
+    # A term with no valid types (e.g. every type the model gave was
+    # hallucinated) is asked again next time instead of answering
+    # nothing for the whole cache TTL.
+    return {term: types for term, types in answers.items() if types}
+
+
+def combine(terms, matches):
+    types = []
+    for term in terms:
+        types.extend(matches.get(term, []))
+    return GooglePlacesTypeList(types=list(dict.fromkeys(types)))
+
+
+# Function to call the LLM API. Terms the local matcher recognizes
+# never reach it, and results are cached per term, so only terms nobody
+# has asked about recently are sent to the model.
+@metrics.instrumented
+def match_to_places_api_types(input_list):
+    terms = prepare_terms(input_list)
+    matches = match_locally(terms)
+    matches.update(lookup_types([term for term in terms if term not in matches]))
+
+    unseen = [term for term in terms if term not in matches]
+    if unseen:
+        # Don't hold a database connection while waiting on the model
+        database.release_request_session()
+        try:
+            answers = in_flight.do(tuple(sorted(unseen)), call_llm, unseen, timeout=llm_timeout)
+        except Exception:
+            # Degrade to the local and cached matches rather than fail
+            logger.warning("LLM unavailable, answering %s without it", unseen, exc_info=True)
+            answers = {}
+        answers_to_cache = cacheable(answers)
+        for term, types in answers_to_cache.items():
+            type_cache.set(term, types)
+        try:
+            database.db_cache_types(answers_to_cache)
+        except Exception:
+            logger.warning("Caching preference types failed", exc_info=True)
+        matches.update(answers)
+
+    return combine(terms, matches)
+
+
+@metrics.instrumented
+async def match_to_places_api_types_async(input_list):
+    """
+    Async version of match_to_places_api_types.
+    """
+    import async_database
+
+    terms = prepare_terms(input_list)
+    matches = match_locally(terms)
+    found, missing = lookup_memory([term for term in terms if term not in matches])
+    matches.update(found)
+    if missing:
+        try:
+            cached = await async_database.db_get_cached_types(missing, llm_cache_ttl)
+        except Exception:
+            logger.warning("Reading cached preference types failed", exc_info=True)
+            cached = {}
+        for term, types in cached.items():
+            type_cache.set(term, types)
+        matches.update(cached)
+
+    unseen = [term for term in terms if term not in matches]
+    if unseen:
+        try:
+            answers = await async_in_flight.do(tuple(sorted(unseen)), call_llm_async, unseen)
+        except Exception:
+            logger.warning("LLM unavailable, answering %s without it", unseen, exc_info=True)
+            answers = {}
+        answers_to_cache = cacheable(answers)
+        for term, types in answers_to_cache.items():
+            type_cache.set(term, types)
+        try:
+            await async_database.db_cache_types(answers_to_cache)
+        except Exception:
+            logger.warning("Caching preference types failed", exc_info=True)
+        matches.update(answers)
+
+    return combine(terms, matches)
@@ -0,0 +1,231 @@
+# Request timing instrumentation.
+#
+# Hot-path stages (token verification, userinfo, every database.db_*
+# call, secrets, the LLM, outbound HTTP, JSON encoding) are wrapped in
+# timed() or @instrumented. Each measurement goes into a latency
+# histogram labeled with the endpoint and stage, and into the list of
+# stages of the current request, which is sent back in a Server-Timing
+# header (https://www.w3.org/TR/server-timing/). /api/metrics serves
+# the histograms, plus gauges from the pools and caches, in the
+# Prometheus text format.
+#
+# Measuring a stage is two perf_counter() calls and a short critical
+# section, cheap enough to leave on in production. The current request
+# is tracked with a ContextVar, so this works the same for gunicorn
+# threads and for coroutines in the ASGI mode.
+
+import asyncio
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from config import metrics_enabled, server_timing
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = "dayscape"
+
+
+class Histogram:
+    """
+    Prometheus-style histogram with one series per label tuple.
+    """
+
+    def __init__(self, name, documentation, label_names, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # per-bucket counts (plus +Inf), sum
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def series(self):
+        with self._lock:
+            return {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.series().items()):
+            label_text = format_labels(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{self.name}_bucket{{{label_text},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{label_text}}} {cumulative}")
+        return lines
+
+
+def format_labels(pairs):
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                    for name, value in pairs)
+
+
+request_seconds = Histogram(f"{PREFIX}_request_seconds",
+                            "Request latency by endpoint.", ("endpoint", "method", "status"))
+stage_seconds = Histogram(f"{PREFIX}_stage_seconds",
+                          "Latency of each stage of a request, by endpoint.", ("endpoint", "stage"))
+
+# (endpoint, [(stage, seconds), ...], start) of the request being handled
+_current = contextvars.ContextVar("metrics_request", default=None)
+
+
+def start_request(endpoint):
+    """
+    Starts collecting the stages of a request. Returns a token for
+    finish_request.
+    """
+    if not metrics_enabled:
+        return None
+    return _current.set((endpoint or "unknown", [], time.perf_counter()))
+
+
+def finish_request(token, method, status):
+    """
+    Records the request's total latency and returns its Server-Timing
+    header value (None if disabled).
+    """
+    if token is None:
+        return None
+    current = _current.get()
+    _current.reset(token)
+    if current is None:
+        return None
+    endpoint, stages, start = current
+    total = time.perf_counter() - start
+    request_seconds.observe((endpoint, method, str(status)), total)
+    if not server_timing:
+        return None
+    return server_timing_header(stages, total)
+
+
+def record(stage, seconds):
+    if not metrics_enabled:
+        return
+    current = _current.get()
+    if current is None:
+        # Background work (warm up, sweeper, refresh-ahead)
+        stage_seconds.observe(("background", stage), seconds)
+        return
+    endpoint, stages, start = current
+    stages.append((stage, seconds))
+    stage_seconds.observe((endpoint, stage), seconds)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def instrumented(f=None, stage=None):
+    """
+    Decorator recording every call of f as a stage named after it.
+    Works on plain and async functions.
+    """
+    if f is None:
+        return functools.partial(instrumented, stage=stage)
+    name = stage or f.__name__
+    if asyncio.iscoroutinefunction(f):
+        @functools.wraps(f)
+        async def decorated_async(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return decorated_async
+
+    @functools.wraps(f)
+    def decorated(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return decorated
+
+
+def server_timing_header(stages, total):
+    """
+    Formats the stages (summed per stage name, in order of first
+    appearance) and the total as a Server-Timing header value.
+    """
+    durations = {}
+    for stage, seconds in stages:
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    parts = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in durations.items()]
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+
+# name -> callable returning a dict of numbers (or of dicts of numbers,
+# keyed by a label value), exported as gauges
+_gauges = {}
+
+
+def register_gauges(name, collect, label=None):
+    _gauges[name] = (collect, label)
+
+
+def exposition(gauges=True):
+    """
+    Returns all metrics in the Prometheus text format, without the
+    registered gauges if gauges is False.
+    """
+    lines = request_seconds.exposition() + stage_seconds.exposition()
+    registered = sorted(_gauges.items()) if gauges else []
+    for name, (collect, label) in registered:
+        try:
+            values = collect()
+        except Exception as e:
+            lines.append(f"# {name} unavailable: {e!r}")
+            continue
+        # Lines of the same metric must be grouped together
+        families = {}
+        for key, value in sorted(values.items()):
+            if isinstance(value, dict):
+                # e.g. per-host stats: {host: {metric: value}}
+                for metric, number in sorted(value.items()):
+                    number = gauge_value(number)
+                    if number is not None:
+                        families.setdefault(f"{PREFIX}_{name}_{metric}", []).append(
+                            f"{PREFIX}_{name}_{metric}{{{format_labels([(label, key)])}}} {number}")
+            else:
+                value = gauge_value(value)
+                if value is not None:
+                    families.setdefault(f"{PREFIX}_{name}_{key}", []).append(f"{PREFIX}_{name}_{key} {value}")
+        for family, family_lines in families.items():
+            lines.append(f"# TYPE {family} gauge")
+            lines.extend(family_lines)
+    return "\n".join(lines) + "\n"
+
+
+def gauge_value(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    return None
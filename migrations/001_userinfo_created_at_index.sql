@@ -0,0 +1,5 @@
+-- Index used by the background userinfo sweeper (sweeper.py) to find
+-- expired rows. Run against both dayscape-dev and dayscape-prod:
+-- PGPASSWORD=<password> psql -h <IP> -U postgres -d dayscape-dev -f migrations/001_userinfo_created_at_index.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_userinfo_created_at ON userinfo(created_at);
@@ -0,0 +1,11 @@
+-- GIN indexes so db_get_shared_trips ("viewers @> ARRAY[email] OR
+-- editors @> ARRAY[email]") doesn't scan the whole trip table.
+-- Run against both dayscape-dev and dayscape-prod:
+-- PGPASSWORD=<password> psql -h <IP> -U postgres -d dayscape-dev -f migrations/002_trip_sharing_gin_indexes.sql
+
+-- Older rows may have NULL instead of an empty list
+UPDATE trip SET viewers = '{}' WHERE viewers IS NULL;
+UPDATE trip SET editors = '{}' WHERE editors IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_trip_viewers ON trip USING GIN (viewers);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_trip_editors ON trip USING GIN (editors);
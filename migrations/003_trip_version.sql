@@ -0,0 +1,5 @@
+-- Trip version, incremented by db_save_trip and used as the ETag of
+-- get_trip. Run against both dayscape-dev and dayscape-prod:
+-- PGPASSWORD=<password> psql -h <IP> -U postgres -d dayscape-dev -f migrations/003_trip_version.sql
+
+ALTER TABLE trip ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1;
@@ -0,0 +1,8 @@
+-- Last save time of each trip, used to paginate the trip lists by
+-- (updated_at, id). Existing trips get the time of the migration.
+-- Run against both dayscape-dev and dayscape-prod:
+-- PGPASSWORD=<password> psql -h <IP> -U postgres -d dayscape-dev -f migrations/004_trip_updated_at.sql
+
+ALTER TABLE trip ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_trip_owner_updated ON trip(owner, updated_at DESC, id DESC);
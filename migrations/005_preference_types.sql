@@ -0,0 +1,11 @@
+-- Cache of LLM answers for /api/public/preferences_to_types (llm.py).
+-- Run against both dayscape-dev and dayscape-prod:
+-- PGPASSWORD=<password> psql -h <IP> -U postgres -d dayscape-dev -f migrations/005_preference_types.sql
+
+CREATE TABLE IF NOT EXISTS preference_types (
+    term TEXT PRIMARY KEY,
+    types JSONB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON preference_types TO "dayscape";
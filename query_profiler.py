@@ -0,0 +1,295 @@
+# SQL profiling. When enabled (DB_PROFILE=1), SQLAlchemy engine events
+# time every statement the app sends to Postgres and count the rows and
+# bytes it returned, e.g. to catch whole trip_data blobs loaded just for
+# a permission check. Statements are tagged with a trailing
+# /*endpoint='...'*/ comment, so they can be told apart in the Postgres
+# logs and pg_stat_statements too.
+#
+# Statements are aggregated per endpoint (statements, sessions opened by
+# database.session_scope, DB time, rows, bytes, most statements in one
+# request), served at /api/query_stats and /api/metrics. Statements
+# slower than DB_SLOW_QUERY_MS are logged with their EXPLAIN plan.
+#
+# capture() collects the statements run inside it, whether or not
+# profiling is enabled for the app, so tests can assert how many queries
+# an operation makes.
+
+import collections
+import contextvars
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from config import db_profile, db_slow_query_ms, db_explain_slow
+
+logger = logging.getLogger(__name__)
+
+# Most recent slow statements kept for /api/query_stats (without
+# parameters or plans)
+SLOW_QUERY_HISTORY = 50
+
+# EXPLAIN without ANALYZE only plans the statement, so it's safe for
+# writes too
+EXPLAIN_PREFIX = {"postgresql": "EXPLAIN ", "sqlite": "EXPLAIN QUERY PLAN "}
+EXPLAINABLE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+
+QueryRecord = collections.namedtuple("QueryRecord", "endpoint statement seconds rows bytes")
+
+
+class EndpointStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+        self.sessions = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.slow = 0
+        self.statements_max = 0
+
+    def add(self, statements, sessions, seconds, rows, size, slow):
+        self.statements += statements
+        self.sessions += sessions
+        self.seconds += seconds
+        self.rows += rows
+        self.bytes += size
+        self.slow += slow
+
+    def as_dict(self):
+        per_request = self.requests or 1
+        return {
+            "requests": self.requests,
+            "statements": self.statements,
+            "statements_per_request": round(self.statements / per_request, 3),
+            "statements_max": self.statements_max,
+            "sessions": self.sessions,
+            "seconds_total": round(self.seconds, 6),
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "slow": self.slow,
+        }
+
+
+class RequestProfile:
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stats = EndpointStats()
+
+
+_stats = {}
+_slow_queries = collections.deque(maxlen=SLOW_QUERY_HISTORY)
+_lock = threading.Lock()
+
+# RequestProfile of the request being handled
+_request = contextvars.ContextVar("query_profile", default=None)
+# Lists of QueryRecord filled by capture()
+_captures = contextvars.ContextVar("query_captures", default=())
+
+slow_query_ms = db_slow_query_ms
+explain_slow = db_explain_slow
+
+
+def _endpoint_stats(endpoint):
+    stats = _stats.get(endpoint)
+    if stats is None:
+        stats = _stats[endpoint] = EndpointStats()
+    return stats
+
+
+def start_request(endpoint):
+    """
+    Starts counting the statements of a request. Returns a token for
+    finish_request, None if profiling is off.
+    """
+    if not db_profile:
+        return None
+    return _request.set(RequestProfile(endpoint or "unknown"))
+
+
+def finish_request(token):
+    if token is None:
+        return
+    profile = _request.get()
+    _request.reset(token)
+    if profile is None:
+        return
+    counted = profile.stats
+    with _lock:
+        stats = _endpoint_stats(profile.endpoint)
+        stats.requests += 1
+        stats.add(counted.statements, counted.sessions, counted.seconds,
+                  counted.rows, counted.bytes, counted.slow)
+        stats.statements_max = max(stats.statements_max, counted.statements)
+
+
+def session_opened():
+    """
+    Called by database.session_scope, to count sessions (transactions)
+    per request.
+    """
+    profile = _request.get()
+    if profile is not None:
+        profile.stats.sessions += 1
+
+
+@contextmanager
+def capture():
+    """
+    Collects a QueryRecord for every statement run in this context, on
+    engines passed to attach().
+    """
+    queries = []
+    token = _captures.set(_captures.get() + (queries,))
+    try:
+        yield queries
+    finally:
+        _captures.reset(token)
+
+
+def stats():
+    """
+    Returns a dict of endpoint -> statement, session, row and byte counts.
+    Statements run outside of a request are counted under "background".
+    """
+    with _lock:
+        return {endpoint: endpoint_stats.as_dict() for endpoint, endpoint_stats in _stats.items()}
+
+
+def slow_queries():
+    with _lock:
+        return list(_slow_queries)
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
+        _slow_queries.clear()
+
+
+def attach(engine):
+    """
+    Installs the profiling event listeners on an engine (for an
+    AsyncEngine, pass engine.sync_engine).
+    """
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute, retval=True)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+    return engine
+
+
+def _tag(endpoint):
+    # Endpoint names go into the SQL text; keep them to characters that
+    # can't end the comment or look like a bind parameter
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", endpoint)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _request.get()
+    endpoint = profile.endpoint if profile is not None else "background"
+    statement = f"{statement} /*endpoint='{_tag(endpoint)}'*/"
+    conn.info.setdefault("query_profiler_start", []).append(time.perf_counter())
+    return statement, parameters
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["query_profiler_start"].pop()
+    rows, size = (max(cursor.rowcount, 0), 0) if executemany else result_size(cursor)
+    slow = bool(slow_query_ms) and seconds * 1000 >= slow_query_ms
+    profile = _request.get()
+    endpoint = profile.endpoint if profile is not None else "background"
+
+    if profile is not None:
+        profile.stats.add(1, 0, seconds, rows, size, slow)
+    else:
+        with _lock:
+            _endpoint_stats(endpoint).add(1, 0, seconds, rows, size, slow)
+
+    if slow:
+        plan = explain(conn, cursor, statement, parameters) if explain_slow and not executemany else None
+        logger.warning("Slow query (%.1f ms, %d rows, %d bytes) in %s: %s%s",
+                       seconds * 1000, rows, size, endpoint, statement,
+                       "\n" + plan if plan else "")
+        # The plan is only logged: EXPLAIN runs with the parameters
+        # bound, so its text holds their values (tokens, emails)
+        with _lock:
+            _slow_queries.append({"endpoint": endpoint, "statement": statement,
+                                  "ms": round(seconds * 1000, 3), "rows": rows,
+                                  "bytes": size})
+
+    captures = _captures.get()
+    if captures:
+        record = QueryRecord(endpoint, statement, seconds, rows, size)
+        for queries in captures:
+            queries.append(record)
+
+
+def _handle_error(exception_context):
+    # The failed statement never reaches after_cursor_execute
+    conn = exception_context.connection
+    if conn is not None and exception_context.cursor is not None:
+        starts = conn.info.get("query_profiler_start")
+        if starts:
+            starts.pop()
+
+
+def result_size(cursor):
+    """
+    Returns (rows, approximate bytes) of a statement's result. Only
+    DBAPI cursors that can scroll back after reading (psycopg2's) have
+    their bytes counted; for the others bytes is 0.
+    """
+    rows = max(cursor.rowcount, 0)
+    if cursor.description is None or not hasattr(cursor, "scroll"):
+        return rows, 0
+    fetched = cursor.fetchall()
+    cursor.scroll(0, mode="absolute")
+    return len(fetched), sum(value_size(value) for row in fetched for value in row)
+
+
+def value_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, (dict, list)):
+        return len(json.dumps(value, default=str))
+    return len(str(value))
+
+
+def explain(conn, cursor, statement, parameters):
+    """
+    Returns the plan of a statement as text, or None if it can't be
+    explained. Runs on the same DBAPI connection (so it sees the same
+    transaction) without going through the engine events; on Postgres it
+    runs inside a savepoint, so a failure can't abort the transaction.
+    """
+    prefix = EXPLAIN_PREFIX.get(conn.dialect.name)
+    if prefix is None or not EXPLAINABLE.match(statement):
+        return None
+    dbapi_connection = cursor.connection
+    savepoint = conn.dialect.name == "postgresql" and not getattr(dbapi_connection, "autocommit", True)
+    explain_cursor = dbapi_connection.cursor()
+    try:
+        if savepoint:
+            explain_cursor.execute("SAVEPOINT query_profiler_explain")
+        try:
+            explain_cursor.execute(prefix + statement, parameters)
+            plan = "\n".join(str(row[-1]) for row in explain_cursor.fetchall())
+        except Exception as e:
+            if savepoint:
+                explain_cursor.execute("ROLLBACK TO SAVEPOINT query_profiler_explain")
+            logger.info("Could not explain slow query: %r", e)
+            plan = None
+        if savepoint:
+            explain_cursor.execute("RELEASE SAVEPOINT query_profiler_explain")
+        return plan
+    finally:
+        explain_cursor.close()
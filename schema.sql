@@ -19,10 +19,19 @@ CREATE TABLE trip (
     viewers TEXT[] DEFAULT '{}',
     editors TEXT[] DEFAULT '{}',
     trip_data JSONB,
+    -- incremented on every save; the ETag of get_trip
+    version BIGINT NOT NULL DEFAULT 1,
+    -- time of the last save, for paginating trip lists
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     CHECK (owner ~* '^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}$')
 );
 
 CREATE INDEX idx_trip_owner ON trip(owner);
+-- Paginated owned trips list, most recently saved first
+CREATE INDEX idx_trip_owner_updated ON trip(owner, updated_at DESC, id DESC);
+-- For finding trips shared with a user (viewers @> ARRAY[email])
+CREATE INDEX idx_trip_viewers ON trip USING GIN (viewers);
+CREATE INDEX idx_trip_editors ON trip USING GIN (editors);
 
 CREATE TABLE preference (
     email VARCHAR(255) PRIMARY KEY,
@@ -41,7 +50,18 @@ CREATE TABLE userinfo (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Expired rows are purged in batches by sweeper.py
+CREATE INDEX idx_userinfo_created_at ON userinfo(created_at);
+
+-- Cached LLM answers for /api/public/preferences_to_types: the Google
+-- Places types for each normalized preference term
+CREATE TABLE preference_types (
+    term TEXT PRIMARY KEY,
+    types JSONB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
 
 GRANT SELECT, INSERT, UPDATE, DELETE ON trip TO "dayscape";
 GRANT SELECT, INSERT, UPDATE, DELETE ON preference TO "dayscape";
 GRANT SELECT, INSERT, UPDATE, DELETE ON userinfo TO "dayscape";
+GRANT SELECT, INSERT, UPDATE, DELETE ON preference_types TO "dayscape";
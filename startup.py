@@ -0,0 +1,47 @@
+# Cold-start timing. Cloud Run starts new instances on demand, so
+# everything done before the first request is served is latency that
+# users see. Imports and resource initialization are wrapped in
+# timed(), and report() prints the breakdown once the instance is warm
+# so the cold-start budget (config.cold_start_budget) can be tracked in
+# the logs over time.
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+started_at = time.perf_counter()
+
+# list of (phase name, start offset, seconds)
+timings = []
+_lock = threading.Lock()
+
+
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with _lock:
+            timings.append((name, round(start - started_at, 4), round(end - start, 4)))
+
+
+def report(budget=None):
+    """
+    Prints the startup timing breakdown as one JSON log line and returns
+    it. Warns if the total exceeds budget (seconds).
+    """
+    total = time.perf_counter() - started_at
+    with _lock:
+        phases = [{"phase": name, "start": start, "seconds": seconds}
+                  for name, start, seconds in timings]
+    result = {"startup_seconds": round(total, 4), "phases": phases}
+    if budget is not None:
+        result["budget_seconds"] = budget
+        result["over_budget"] = total > budget
+    print("Startup timing: " + json.dumps(result))
+    if budget is not None and total > budget:
+        print(f"WARNING: cold start took {total:.2f}s, over the {budget}s budget")
+    return result
@@ -0,0 +1,70 @@
+# Background thread that periodically purges expired rows from the
+# userinfo cache table, so authenticated requests never have to.
+#
+# Every instance runs the thread, but database.db_purge_userinfo takes
+# a Postgres advisory lock so only one of them sweeps at a time.
+
+import logging
+import random
+import threading
+import time
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Result of the most recent sweep by this instance, exported at
+# /api/metrics as the dayscape_userinfo_sweep_* gauges
+last_sweep = {"purged": None, "duration": None, "finished_at": None}
+
+_stop = threading.Event()
+_thread = None
+
+
+def sweep(batch_size):
+    """
+    Runs one sweep and records the rows purged and how long it took.
+    """
+    start = time.monotonic()
+    purged = database.db_purge_userinfo(batch_size)
+    duration = time.monotonic() - start
+    last_sweep.update(purged=purged, duration=duration, finished_at=time.time())
+    if purged is None:
+        logger.info("userinfo sweep skipped, another instance holds the lock")
+    else:
+        logger.info("userinfo sweep purged %d rows in %.3fs", purged, duration)
+    return purged
+
+
+def _run(interval, batch_size):
+    # Spread the first sweep out so instances that start together don't
+    # all try to take the lock at the same moment.
+    if _stop.wait(random.uniform(0, interval)):
+        return
+    while True:
+        try:
+            sweep(batch_size)
+        except Exception:
+            logger.exception("userinfo sweep failed")
+        if _stop.wait(interval):
+            return
+
+
+def start(interval, batch_size):
+    """
+    Starts the sweeper thread (once per process). interval is in
+    seconds; 0 disables sweeping.
+    """
+    global _thread
+    if interval <= 0 or _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run, args=(interval, batch_size),
+                               name="userinfo-sweeper", daemon=True)
+    _thread.start()
+
+
+def stop():
+    global _thread
+    _stop.set()
+    _thread = None
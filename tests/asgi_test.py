@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("asgiref")
+pytest.importorskip("asyncpg")
+
+import asgi
+import async_database
+
+
+def request(method, url, **kwargs):
+    async def send():
+        transport = httpx.ASGITransport(app=asgi.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.request(method, url, **kwargs)
+    return asyncio.run(send())
+
+
+def test_get_trip_is_served_natively(auth_headers, monkeypatch):
+    async def db_get_trip_json(email, trip_id):
+        assert (email, trip_id) == ("owner@example.com", "abc")
+        return '{"days": []}', 7
+    monkeypatch.setattr(async_database, "db_get_trip_json", db_get_trip_json)
+    r = request("POST", "/api/private/get_trip?trip_id=abc",
+                headers=dict(auth_headers, Origin=asgi.client_origin_url))
+    assert r.status_code == 200
+    assert r.json() == {"days": []}
+    assert r.headers["ETag"] == '"7"'
+    assert r.headers["Access-Control-Allow-Origin"] == asgi.client_origin_url
+
+
+def test_get_trip_not_modified(auth_headers, monkeypatch):
+    async def db_get_trip_version(email, trip_id):
+        return 7
+    monkeypatch.setattr(async_database, "db_get_trip_version", db_get_trip_version)
+    r = request("POST", "/api/private/get_trip?trip_id=abc",
+                headers=dict(auth_headers, **{"If-None-Match": '"7"'}))
+    assert r.status_code == 304
+    assert r.content == b""
+
+
+def test_get_trip_permission_errors(auth_headers, monkeypatch):
+    async def db_get_trip_json(email, trip_id):
+        raise PermissionError("Authenticated user does not have permission to view this trip.")
+    monkeypatch.setattr(async_database, "db_get_trip_json", db_get_trip_json)
+    r = request("POST", "/api/private/get_trip?trip_id=abc", headers=auth_headers)
+    assert r.status_code == 403
+
+
+def test_missing_token_is_rejected():
+    r = request("GET", "/api/private/get_preferences")
+    assert r.status_code == 401
+    assert r.json()["code"] == "authorization_header_missing"
+
+
+def test_trips_page_matches_flask(auth_headers, monkeypatch):
+    async def db_list_trips(email, scope, limit, cursor):
+        assert (scope, limit, cursor) == ("owned", 2, None)
+        return [("a", None, "owner", None)], "next"
+    monkeypatch.setattr(async_database, "db_list_trips", db_list_trips)
+    r = request("GET", "/api/private/get_owned_trips_list?limit=2", headers=auth_headers)
+    assert r.json() == {"trips": [{"uuid": "a", "name": ""}], "next_cursor": "next"}
+
+    r = request("GET", "/api/private/get_trips_list?fields=bogus", headers=auth_headers)
+    assert r.status_code == 400
+
+
+def test_other_routes_go_to_flask(auth_headers, monkeypatch):
+    monkeypatch.setattr(asgi.flask_app.database, "db_get_owned_trips",
+                        lambda email: [("a", "Paris")])
+    r = request("GET", "/api/private/get_owned_trips_list", headers=auth_headers)
+    assert r.json() == [{"uuid": "a", "name": "Paris"}]
+    r = request("GET", "/api/healthcheck")
+    assert r.status_code == 200
+
+
+def test_preferences_to_types(monkeypatch):
+    async def db_get_cached_types(terms, max_age):
+        return {}
+    monkeypatch.setattr(async_database, "db_get_cached_types", db_get_cached_types)
+    r = request("POST", "/api/public/preferences_to_types", json={"input_list": ["zoos"]})
+    assert r.json() == {"matched_list": ["zoo"]}
@@ -0,0 +1,47 @@
+import time
+
+from cache import LRUCache
+
+
+def test_hit_and_miss_counters():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_is_evicted():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert len(cache) == 2
+    assert cache.evictions == 1
+
+
+def test_never_returns_expired_entries():
+    cache = LRUCache()
+    cache.set("token", {"sub": "x"}, expires_at=time.time() + 0.05)
+    assert cache.get("token") == {"sub": "x"}
+    time.sleep(0.06)
+    assert cache.get("token") is None
+    assert len(cache) == 0
+
+
+def test_already_expired_entries_are_not_stored():
+    cache = LRUCache()
+    cache.set("token", {"sub": "x"}, expires_at=time.time() - 1)
+    assert len(cache) == 0
+
+
+def test_default_ttl():
+    cache = LRUCache(ttl=0.05)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
@@ -0,0 +1,26 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+# Unit tests run without GCP credentials or network access.
+os.environ.setdefault("SECRETS_BACKEND", "local")
+os.environ.setdefault("WARM_UP_ON_START", "0")
+os.environ.setdefault("USERINFO_SWEEP_INTERVAL", "0")
+
+
+@pytest.fixture
+def auth_headers():
+    # Seed the verified-token and userinfo caches so requires_auth
+    # accepts this token without Auth0 or the database.
+    import app
+
+    token = "test-token"
+    token_key = hashlib.sha256(token.encode()).hexdigest()
+    expires_at = time.time() + 60
+    app.verified_tokens.set(token_key, {"sub": "test", "exp": expires_at}, expires_at=expires_at)
+    app.userinfo_cache.set(token_key, {"email": "owner@example.com"}, expires_at=expires_at)
+    yield {"Authorization": "Bearer " + token}
+    app.verified_tokens.clear()
+    app.userinfo_cache.clear()
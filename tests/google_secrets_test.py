@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+import google_secrets
+
+
+@pytest.fixture(autouse=True)
+def local_backend(monkeypatch, tmp_path):
+    monkeypatch.setattr(google_secrets, "secrets_backend", "local")
+    monkeypatch.setattr(google_secrets, "secrets_file", str(tmp_path / "secrets.json"))
+    google_secrets._cache.clear()
+    yield
+    google_secrets._cache.clear()
+
+
+def test_reads_environment(monkeypatch):
+    monkeypatch.setenv("SECRET_MAPS_API_KEY", "abc")
+    assert google_secrets.get_secret("maps_api_key") == "abc"
+
+
+def test_reads_secrets_file(tmp_path):
+    (tmp_path / "secrets.json").write_text('{"db_ip": "10.0.0.1"}')
+    assert google_secrets.get_secret("db_ip") == "10.0.0.1"
+
+
+def test_missing_secret_raises():
+    with pytest.raises(KeyError):
+        google_secrets.get_secret("nope")
+
+
+def test_values_are_cached(monkeypatch):
+    calls = []
+    monkeypatch.setattr(google_secrets, "access_secret", lambda name: calls.append(name) or "v")
+    for _ in range(5):
+        google_secrets.get_secret("openai")
+    assert calls == ["openai"]
+
+
+def test_expired_value_survives_failed_refresh(monkeypatch):
+    monkeypatch.setenv("SECRET_OPENAI", "old")
+    google_secrets.get_secret("openai", ttl=0.01)
+    time.sleep(0.02)
+
+    def down(name):
+        raise OSError("secret manager is down")
+    monkeypatch.setattr(google_secrets, "access_secret", down)
+    assert google_secrets.get_secret("openai", ttl=0.01) == "old"
+
+
+def test_prefetch_is_concurrent(monkeypatch):
+    def slow(name):
+        time.sleep(0.1)
+        return name.upper()
+    monkeypatch.setattr(google_secrets, "access_secret", slow)
+    start = time.monotonic()
+    values = google_secrets.prefetch(["db_ip", "db_password", "openai", "maps_api_key"])
+    assert time.monotonic() - start < 0.3
+    assert values["openai"] == "OPENAI"
@@ -0,0 +1,49 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("httpx")
+
+import http_client
+import jwks
+
+
+@pytest.fixture
+def server():
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = json.dumps({"keys": []}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Cache-Control", "public, max-age=900")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    http_client.reset_stats()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_connections_are_reused(server):
+    for _ in range(3):
+        assert http_client.get_client().get(server + "/userinfo").json() == {"keys": []}
+    stats = http_client.stats()["127.0.0.1"]
+    assert stats["requests"] == 3
+    assert stats["new_connections"] == 1
+    assert stats["reused_connections"] == 2
+
+
+def test_fetch_jwks_uses_the_shared_client(server):
+    assert jwks.fetch_jwks(server + "/.well-known/jwks.json") == ({"keys": []}, 900)
+    assert http_client.stats()["127.0.0.1"]["requests"] == 1
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from jwks import JWKSKeyStore, parse_max_age
+
+KEY = {"kty": "RSA", "kid": "key1", "use": "sig", "n": "abc", "e": "AQAB", "x5c": ["ignored"]}
+KEY2 = dict(KEY, kid="key2")
+
+
+class FakeAuth0:
+    def __init__(self, keys, max_age=None, delay=0):
+        self.keys = keys
+        self.max_age = max_age
+        self.delay = delay
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self, url):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise OSError("auth0 is down")
+        return {"keys": list(self.keys)}, self.max_age
+
+
+def test_parse_max_age():
+    assert parse_max_age("public, max-age=15000, stale-while-revalidate=15") == 15000
+    assert parse_max_age("no-store") == 0
+    assert parse_max_age(None) is None
+
+
+def test_keys_are_cached():
+    auth0 = FakeAuth0([KEY])
+    store = JWKSKeyStore("https://example/jwks.json", fetch=auth0)
+    for _ in range(10):
+        assert store.get_key("key1")["n"] == "abc"
+    assert "x5c" not in store.get_key("key1")
+    assert auth0.calls == 1
+
+
+def test_unknown_kid_refetches_once():
+    auth0 = FakeAuth0([KEY])
+    store = JWKSKeyStore("https://example/jwks.json", miss_interval=0, fetch=auth0)
+    store.get_key("key1")
+    auth0.keys = [KEY, KEY2]
+    assert store.get_key("key2")["kid"] == "key2"
+    assert auth0.calls == 2
+
+
+def test_unknown_kid_refetch_is_rate_limited():
+    auth0 = FakeAuth0([KEY])
+    store = JWKSKeyStore("https://example/jwks.json", miss_interval=60, fetch=auth0)
+    for _ in range(5):
+        assert store.get_key("bogus") is None
+    assert auth0.calls == 1
+
+
+def test_failed_refresh_keeps_last_good_keys():
+    auth0 = FakeAuth0([KEY], max_age=0)
+    store = JWKSKeyStore("https://example/jwks.json", min_ttl=0, fetch=auth0)
+    store.get_key("key1")
+    auth0.fail = True
+    assert store.get_key("key1")["kid"] == "key1"
+    assert store.failures == 1
+
+
+def test_concurrent_misses_share_one_fetch():
+    auth0 = FakeAuth0([KEY], delay=0.1)
+    store = JWKSKeyStore("https://example/jwks.json", fetch=auth0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.get_key("key1")))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert auth0.calls == 1
+    assert all(r["kid"] == "key1" for r in results)
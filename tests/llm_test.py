@@ -0,0 +1,170 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import llm
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+from stubs import StubServer
+
+
+@pytest.fixture
+def fake_backends(monkeypatch):
+    llm.type_cache.clear()
+    db = {"street food": ["restaurant", "meal_takeaway"]}
+    asked = []
+
+    def ask_llm(terms, timeout=None):
+        asked.append(list(terms))
+        answers = {"rainy day": ["museum", "movie_theater"], "kids": ["amusement_park", "zoo"]}
+        return {term: answers.get(term, []) for term in terms}
+
+    def db_cache_types(matches):
+        db.update(matches)
+
+    monkeypatch.setattr(llm, "ask_llm", ask_llm)
+    monkeypatch.setattr(llm.database, "db_get_cached_types",
+                        lambda terms, max_age: {t: db[t] for t in terms if t in db})
+    monkeypatch.setattr(llm.database, "db_cache_types", db_cache_types)
+    yield asked, db
+    llm.type_cache.clear()
+
+
+def test_only_unseen_terms_go_to_the_model(fake_backends):
+    asked, db = fake_backends
+    result = llm.match_to_places_api_types(["Street  Food", "rainy day", " kids "])
+    assert result.types == ["restaurant", "meal_takeaway", "museum", "movie_theater", "amusement_park", "zoo"]
+    assert asked == [["rainy day", "kids"]]
+    assert db["rainy day"] == ["museum", "movie_theater"]
+
+    result = llm.match_to_places_api_types(["kids", "RAINY DAY", "street food"])
+    assert result.types == ["amusement_park", "zoo", "museum", "movie_theater", "restaurant", "meal_takeaway"]
+    assert len(asked) == 1
+
+
+def test_local_matches_skip_the_model(fake_backends):
+    asked, db = fake_backends
+    assert llm.match_to_places_api_types(["Zoos", "art galleries"]).types == ["zoo", "art_gallery"]
+    assert asked == []
+
+
+def test_database_outage_falls_back_to_the_model(fake_backends, monkeypatch):
+    asked, db = fake_backends
+
+    def down(*args):
+        raise OSError("database is down")
+    monkeypatch.setattr(llm.database, "db_get_cached_types", down)
+    monkeypatch.setattr(llm.database, "db_cache_types", down)
+    assert llm.match_to_places_api_types(["rainy day"]).types == ["museum", "movie_theater"]
+
+
+def test_invalid_types_are_not_cached(monkeypatch):
+    class Parsed:
+        matches = [llm.TermTypes(term="Zoo", types=["zoo", "safari_park"])]
+
+    class Choice:
+        message = type("Message", (), {"parsed": Parsed})
+
+    class FakeClient:
+        class beta:
+            class chat:
+                class completions:
+                    @staticmethod
+                    def parse(**kwargs):
+                        return type("Response", (), {"choices": [Choice]})
+
+    monkeypatch.setattr(llm, "get_client", lambda: FakeClient)
+    assert llm.ask_llm(["zoo"]) == {"zoo": ["zoo"]}
+
+
+@pytest.fixture
+def stub_openai(fake_backends, monkeypatch):
+    """
+    The benchmarks' stub server standing in for the OpenAI API, answering
+    "museum" for every term. Tests set llm_delay and llm_failures.
+    """
+    openai = pytest.importorskip("openai")
+    stub = StubServer(None, llm_delay=0.0, llm_types=["museum"]).start()
+    client = openai.OpenAI(api_key="test", base_url=stub.url + "/v1", max_retries=0)
+    monkeypatch.setattr(llm, "ask_llm", ORIGINAL_ASK_LLM)
+    monkeypatch.setattr(llm, "get_client", lambda: client)
+    yield stub
+    stub.stop()
+
+
+ORIGINAL_ASK_LLM = llm.ask_llm
+
+
+def test_llm_call_through_stub_server(stub_openai):
+    assert llm.match_to_places_api_types(["rainy day"]).types == ["museum"]
+    assert stub_openai.counts["llm"] == 1
+
+
+def test_transient_errors_are_retried(stub_openai):
+    stub_openai.llm_failures = 1
+    assert llm.call_llm(["rainy day"], timeout=5) == {"rainy day": ["museum"]}
+    assert stub_openai.counts["llm"] == 2
+
+
+def test_deadline_falls_back_without_the_llm(stub_openai, monkeypatch):
+    stub_openai.llm_delay = 2
+    start = time.monotonic()
+    with pytest.raises(llm.DeadlineExceeded):
+        llm.call_llm(["rainy day"], timeout=0.3)
+    assert time.monotonic() - start < 1.5
+
+    monkeypatch.setattr(llm, "llm_timeout", 0.3)
+    result = llm.match_to_places_api_types(["zoo", "rainy day"])
+    assert result.types == ["zoo"]
+    # The fallback answer isn't cached
+    assert llm.type_cache.get("rainy day") is None
+
+
+def test_identical_requests_share_one_call(stub_openai):
+    stub_openai.llm_delay = 0.3
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        llm.match_to_places_api_types(["rainy day", "kids"]).types)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [["museum"]] * 4
+    assert stub_openai.counts["llm"] == 1
+
+
+def test_no_free_slot_falls_back_immediately(fake_backends, monkeypatch):
+    asked, db = fake_backends
+    monkeypatch.setattr(llm, "llm_timeout", 5)
+    held = 0
+    while llm.llm_slots.acquire(blocking=False):
+        held += 1
+    try:
+        start = time.monotonic()
+        with pytest.raises(llm.DeadlineExceeded):
+            llm.call_llm(["rainy day"])
+        assert llm.match_to_places_api_types(["zoo", "rainy day"]).types == ["zoo"]
+        assert time.monotonic() - start < 1
+    finally:
+        for _ in range(held):
+            llm.llm_slots.release()
+    assert asked == []
+
+
+def test_empty_answers_are_not_cached(fake_backends, monkeypatch):
+    asked, db = fake_backends
+    calls = []
+
+    def ask_llm(terms, timeout=None):
+        # The model only answered with types that aren't valid
+        calls.append(terms)
+        return {term: [] for term in terms}
+    monkeypatch.setattr(llm, "ask_llm", ask_llm)
+    assert llm.match_to_places_api_types(["moon base"]).types == []
+    assert llm.type_cache.get("moon base") is None
+    assert "moon base" not in db
+    llm.match_to_places_api_types(["moon base"])
+    assert len(calls) == 2
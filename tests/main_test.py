@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import os
+import threading
+import time
+import uuid
 
 import pytest
 
@@ -28,3 +32,169 @@ def test_handler_no_env_variable(client):
 
     assert "Healthcheck endpoint OK! You don't need to be authenticated to see this." in r.data.decode()
     assert r.status_code == 200
+
+def test_get_trip_etag(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(app.database, "db_get_trip_json", lambda email, trip_id: ('{"days": []}', 7))
+    r = client.post("/api/private/get_trip?trip_id=abc", headers=auth_headers)
+    assert r.status_code == 200
+    assert r.json == {"days": []}
+    assert r.headers["ETag"] == '"7"'
+
+def test_get_trip_not_modified(client, auth_headers, monkeypatch):
+    def no_trip_data(email, trip_id):
+        raise AssertionError("trip_data should not be read")
+    monkeypatch.setattr(app.database, "db_get_trip_json", no_trip_data)
+    monkeypatch.setattr(app.database, "db_get_trip_version", lambda email, trip_id: 7)
+    r = client.post("/api/private/get_trip?trip_id=abc",
+                    headers=dict(auth_headers, **{"If-None-Match": '"7"'}))
+    assert r.status_code == 304
+    assert r.data == b""
+
+def test_patch_trip_version_conflict(client, auth_headers, monkeypatch):
+    def conflict(email, trip_id, patch, expected_version):
+        assert expected_version == 3
+        raise app.database.VersionConflictError(5)
+    monkeypatch.setattr(app.database, "db_patch_trip", conflict)
+    r = client.post("/api/private/save_trip?trip_id=abc",
+                    headers=dict(auth_headers, **{"If-Match": '"3"'}),
+                    data='[{"op": "remove", "path": "/a"}]',
+                    content_type="application/json-patch+json")
+    assert r.status_code == 409
+    assert r.json["version"] == 5
+
+def test_patch_trip_requires_version(client, auth_headers):
+    r = client.post("/api/private/save_trip?trip_id=abc", headers=auth_headers,
+                    data='[]', content_type="application/json-patch+json")
+    assert r.status_code == 428
+
+def test_trip_lists_serialize_uuids(client, auth_headers, monkeypatch):
+    trip_id = uuid.uuid4()
+    monkeypatch.setattr(app.database, "db_get_owned_trips", lambda email: [(trip_id, None)])
+    r = client.get("/api/private/get_owned_trips_list", headers=auth_headers)
+    assert r.json == [{"uuid": str(trip_id), "name": ""}]
+
+def test_missing_preferences_are_null(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(app.database, "db_get_preferences", lambda email: None)
+    r = client.get("/api/private/get_preferences", headers=auth_headers)
+    assert r.status_code == 200
+    assert r.json is None
+
+def test_trips_list_page(client, auth_headers, monkeypatch):
+    trip_id = uuid.uuid4()
+    def one_page(email, scope, limit, cursor):
+        assert (email, scope, limit, cursor) == ("owner@example.com", "all", 2, "abc")
+        return [(trip_id, "Paris", "editor", None)], None
+    monkeypatch.setattr(app.database, "db_list_trips", one_page)
+    r = client.get("/api/private/get_trips_list?limit=2&cursor=abc&fields=uuid,role", headers=auth_headers)
+    assert r.json == {"trips": [{"uuid": str(trip_id), "role": "editor"}], "next_cursor": None}
+
+def test_email_claim_skips_userinfo(client, monkeypatch):
+    token = "token-with-email"
+    token_key = hashlib.sha256(token.encode()).hexdigest()
+    expires_at = time.time() + 60
+    app.verified_tokens.set(token_key, {"sub": "test", "exp": expires_at,
+                                        "https://dayscape/email": "claim@example.com"},
+                            expires_at=expires_at)
+    def no_userinfo(*args):
+        raise AssertionError("/userinfo should not be needed")
+    monkeypatch.setattr(app, "get_userinfo", no_userinfo)
+    monkeypatch.setattr(app.database, "db_get_preferences", lambda email: {"email": email})
+    r = client.get("/api/private/get_preferences", headers={"Authorization": "Bearer " + token})
+    app.verified_tokens.clear()
+    assert r.json == {"email": "claim@example.com"}
+
+def test_concurrent_userinfo_lookups_share_one_fetch(monkeypatch):
+    fetches = []
+    cached = []
+    def fetch_userinfo(token):
+        fetches.append(token)
+        time.sleep(0.2)
+        return {"email": "owner@example.com"}
+    monkeypatch.setattr(app, "fetch_userinfo", fetch_userinfo)
+    monkeypatch.setattr(app.database, "db_check_userinfo", lambda token: None)
+    monkeypatch.setattr(app.database, "db_cache_userinfo", lambda token, data: cached.append(token))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(app.get_userinfo("new-token")))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    app.userinfo_cache.clear()
+    assert results == [{"email": "owner@example.com"}] * 5
+    assert fetches == ["new-token"]
+    assert cached == ["new-token"]
+
+def test_server_timing_and_metrics(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(app.database, "db_get_preferences", app.metrics.instrumented(
+        lambda email: {"likes": ["zoo"]}, stage="db_get_preferences"))
+    r = client.get("/api/private/get_preferences", headers=auth_headers)
+    assert "db_get_preferences;dur=" in r.headers["Server-Timing"]
+    assert "total;dur=" in r.headers["Server-Timing"]
+
+    monkeypatch.setattr(app, "metrics_token", "scrape-token")
+    text = client.get("/api/metrics", headers={"Authorization": "Bearer scrape-token"}).data.decode()
+    assert 'dayscape_request_seconds_count{endpoint="get_preferences",method="GET",status="200"}' in text
+    assert 'dayscape_stage_seconds_count{endpoint="get_preferences",stage="db_get_preferences"}' in text
+    assert "dayscape_cache_hits{" in text
+
+def test_last_sweep_is_exported(client, monkeypatch):
+    monkeypatch.setattr(app.database, "db_purge_userinfo", lambda batch_size: 3)
+    app.sweeper.sweep(10)
+    monkeypatch.setattr(app, "metrics_token", "scrape-token")
+    text = client.get("/api/metrics", headers={"Authorization": "Bearer scrape-token"}).data.decode()
+    assert "dayscape_userinfo_sweep_purged 3" in text
+    assert "dayscape_userinfo_sweep_duration " in text
+    assert "dayscape_userinfo_sweep_finished_at " in text
+
+def test_anonymous_metrics_scrape_has_no_gauges(client, auth_headers, monkeypatch):
+    client.get("/api/healthcheck")
+    for headers in ({}, auth_headers, {"Authorization": "Bearer wrong-token"}):
+        for token in (None, "scrape-token"):
+            monkeypatch.setattr(app, "metrics_token", token)
+            text = client.get("/api/metrics", headers=headers).data.decode()
+            assert "dayscape_request_seconds_count" in text
+            for family in ("db_pool", "http", "jwks", "queries", "userinfo_governor", "userinfo_sweep", "cache"):
+                assert f"dayscape_{family}_" not in text
+
+def test_query_stats_per_endpoint(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(app.query_profiler, "db_profile", True)
+    app.query_profiler.reset_stats()
+
+    def db_get_preferences(email):
+        app.query_profiler.session_opened()
+        return None
+    monkeypatch.setattr(app.database, "db_get_preferences", db_get_preferences)
+    client.get("/api/private/get_preferences", headers=auth_headers)
+    assert client.get("/api/query_stats").status_code == 401
+    stats = client.get("/api/query_stats", headers=auth_headers).json
+    assert stats["endpoints"]["get_preferences"]["requests"] == 1
+    assert stats["endpoints"]["get_preferences"]["sessions"] == 1
+    monkeypatch.setattr(app, "metrics_token", "scrape-token")
+    text = client.get("/api/metrics", headers={"Authorization": "Bearer scrape-token"}).data.decode()
+    assert 'dayscape_queries_sessions{endpoint="get_preferences"} 1' in text
+    app.query_profiler.reset_stats()
+
+def test_pool_stats_requires_auth(client, auth_headers, monkeypatch):
+    monkeypatch.setattr(app.database, "db_pool_stats", lambda: {"pool": None})
+    assert client.get("/api/pool_stats").status_code == 401
+    assert client.get("/api/pool_stats", headers=auth_headers).json == {"pool": None}
+
+def test_http_stats_requires_auth(client, auth_headers):
+    assert client.get("/api/http_stats").status_code == 401
+    assert client.get("/api/http_stats", headers=auth_headers).status_code == 200
+
+def test_userinfo_rate_limit_is_per_user():
+    from jose import jwt
+    alice = jwt.encode({"sub": "auth0|alice"}, "secret")
+    assert app.userinfo_rate_key(alice) == "auth0|alice"
+    assert app.userinfo_rate_key("not a jwt") == app.token_cache_key("not a jwt")
+
+def test_userinfo_fetch_releases_the_db_session(monkeypatch):
+    events = []
+    monkeypatch.setattr(app.database, "db_check_userinfo", lambda token: events.append("check"))
+    monkeypatch.setattr(app.database, "release_request_session", lambda: events.append("release"))
+    monkeypatch.setattr(app, "fetch_userinfo", lambda token: events.append("fetch") or {"email": "a@b.co"})
+    monkeypatch.setattr(app.database, "db_cache_userinfo", lambda token, data: events.append("cache"))
+    assert app.load_userinfo("token") == {"email": "a@b.co"}
+    assert events == ["check", "release", "fetch", "cache"]
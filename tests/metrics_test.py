@@ -0,0 +1,41 @@
+import metrics
+
+
+def test_histogram_exposition():
+    histogram = metrics.Histogram("test_seconds", "Test.", ("endpoint",), buckets=(0.1, 1.0))
+    histogram.observe(("a",), 0.05)
+    histogram.observe(("a",), 0.5)
+    histogram.observe(("a",), 5)
+    lines = histogram.exposition()
+    assert 'test_seconds_bucket{endpoint="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{endpoint="a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{endpoint="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{endpoint="a"} 3' in lines
+
+
+def test_stages_of_a_request():
+    @metrics.instrumented
+    def db_lookup():
+        return 42
+
+    token = metrics.start_request("some_endpoint")
+    assert db_lookup() == 42
+    with metrics.timed("json"):
+        pass
+    db_lookup()
+    header = metrics.finish_request(token, "GET", 200)
+    stages = [part.split(";")[0] for part in header.split(", ")]
+    assert stages == ["db_lookup", "json", "total"]
+    assert ("some_endpoint", "db_lookup") in metrics.stage_seconds.series()
+    assert sum(metrics.stage_seconds.series()[("some_endpoint", "db_lookup")][0]) == 2
+
+
+def test_gauges():
+    metrics.register_gauges("test_pool", lambda: {"size": 8, "pool": "QueuePool", "ok": True})
+    metrics.register_gauges("test_hosts", lambda: {"a.com": {"requests": 3}}, label="host")
+    text = metrics.exposition()
+    assert "dayscape_test_pool_size 8" in text
+    assert "dayscape_test_pool_ok 1" in text
+    assert "QueuePool" not in text
+    assert 'dayscape_test_hosts_requests{host="a.com"} 3' in text
+    assert "dayscape_test_pool" not in metrics.exposition(gauges=False)
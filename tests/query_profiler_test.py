@@ -0,0 +1,80 @@
+import logging
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import query_profiler
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setattr(query_profiler, "db_profile", True)
+    query_profiler.reset_stats()
+    engine = query_profiler.attach(create_engine("sqlite://"))
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE trip (id INTEGER PRIMARY KEY, name TEXT)"))
+        conn.execute(text("INSERT INTO trip (name) VALUES ('a'), ('b')"))
+    yield engine
+    engine.dispose()
+    query_profiler.reset_stats()
+
+
+def test_statements_are_counted_per_endpoint(engine):
+    token = query_profiler.start_request("get_trip")
+    query_profiler.session_opened()
+    with engine.connect() as conn:
+        for _ in range(3):
+            conn.execute(text("SELECT name FROM trip")).all()
+    query_profiler.finish_request(token)
+
+    stats = query_profiler.stats()
+    assert stats["get_trip"]["requests"] == 1
+    assert stats["get_trip"]["statements"] == 3
+    assert stats["get_trip"]["statements_max"] == 3
+    assert stats["get_trip"]["sessions"] == 1
+    # The table setup ran outside of a request
+    assert stats["background"]["statements"] == 2
+
+
+def test_capture_tags_statements_with_the_endpoint(engine):
+    token = query_profiler.start_request("get_trip_name")
+    with query_profiler.capture() as queries, engine.connect() as conn:
+        assert conn.execute(text("SELECT name FROM trip WHERE id = 1")).scalar() == "a"
+    query_profiler.finish_request(token)
+    assert len(queries) == 1
+    assert queries[0].endpoint == "get_trip_name"
+    assert queries[0].statement.endswith("/*endpoint='get_trip_name'*/")
+
+
+def test_slow_queries_are_logged_with_their_plan(engine, monkeypatch, caplog):
+    monkeypatch.setattr(query_profiler, "slow_query_ms", 0.000001)
+    with caplog.at_level(logging.WARNING, logger="query_profiler"), engine.connect() as conn:
+        conn.execute(text("SELECT name FROM trip WHERE name = :name"), {"name": "a"}).all()
+    slow = query_profiler.slow_queries()
+    assert len(slow) == 1
+    # The plan can contain parameter values, so it's only logged
+    assert "plan" not in slow[0]
+    assert "Slow query" in caplog.text and "SCAN trip" in caplog.text
+
+
+def test_result_size_counts_rows_and_bytes():
+    class ScrollingCursor:
+        # Like a psycopg2 client-side cursor
+        description = [("trip_data",), ("name",)]
+        rowcount = 2
+
+        def __init__(self):
+            self.rows = [({"days": []}, "ab"), (None, "cde")]
+            self.position = 0
+
+        def fetchall(self):
+            rows, self.position = self.rows[self.position:], len(self.rows)
+            return rows
+
+        def scroll(self, value, mode):
+            self.position = value
+
+    cursor = ScrollingCursor()
+    assert query_profiler.result_size(cursor) == (2, len('{"days": []}') + 2 + 3)
+    # Rewound, so the app still gets every row
+    assert cursor.fetchall() == cursor.rows
@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.2)
+        return x * 2
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", slow, 21)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [42] * 5
+    assert calls == [21]
+    assert flight.coalesced == 4
+
+
+def test_errors_reach_waiters_and_are_not_remembered():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.1)
+        raise OSError("boom")
+
+    errors = []
+
+    def waiter():
+        started.wait()
+        try:
+            flight.do("k", fail)
+        except OSError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    with pytest.raises(OSError):
+        flight.do("k", fail)
+    thread.join()
+    assert len(errors) == 1
+    assert flight.do("k", lambda: "ok") == "ok"
+
+
+def test_waiters_time_out():
+    flight = SingleFlight()
+    started = threading.Event()
+    thread = threading.Thread(target=flight.do, args=("k", lambda: (started.set(), time.sleep(0.5))))
+    thread.start()
+    started.wait()
+    with pytest.raises(TimeoutError):
+        flight.do("k", lambda: None, timeout=0.05)
+    thread.join()
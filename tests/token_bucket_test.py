@@ -0,0 +1,32 @@
+from token_bucket import KeyedTokenBuckets, TokenBucket
+
+
+def test_burst_then_queue():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # Further calls queue behind each other instead of failing
+    first = bucket.reserve()
+    second = bucket.reserve()
+    assert 0.05 < first <= 0.1
+    assert 0.15 < second <= 0.2
+    assert bucket.stats()["waits"] == 2
+
+
+def test_max_wait():
+    bucket = TokenBucket(rate=1, capacity=1)
+    assert bucket.acquire(max_wait=0)
+    assert bucket.reserve(max_wait=0.5) is None
+    assert bucket.acquire(max_wait=0) is False
+    assert bucket.stats()["rejected"] == 2
+
+
+def test_keyed_buckets_limit_each_key_separately():
+    buckets = KeyedTokenBuckets(rate=1 / 60, capacity=1, maxsize=2)
+    # Every user gets their own burst
+    assert buckets.reserve("alice", max_wait=0) == 0
+    assert buckets.reserve("bob", max_wait=0) == 0
+    assert buckets.reserve("alice", max_wait=0) is None
+    # Only the most recently used buckets are kept
+    assert buckets.reserve("carol", max_wait=0) == 0
+    assert buckets.stats() == {"keys": 2, "waits": 0, "rejected": 1}
@@ -0,0 +1,49 @@
+import pytest
+
+from llm import places_api_types
+from type_matcher import TypeMatcher, normalize
+
+
+@pytest.fixture
+def matcher():
+    return TypeMatcher(places_api_types, threshold=0.85)
+
+
+@pytest.mark.parametrize("term, types", [
+    ("zoo", ["zoo"]),
+    ("bars", ["bar"]),
+    ("Art Galleries", ["art_gallery"]),
+    ("cafés", ["cafe"]),
+    ("night clubs", ["night_club"]),
+    ("nightclub", ["night_club"]),
+    ("Coffee", ["cafe"]),
+    ("hotels", ["lodging"]),
+    ("amusment park", ["amusement_park"]),
+    ("movies", ["movie_theater"]),
+    ("cookies", ["bakery"]),
+])
+def test_matches(matcher, term, types):
+    assert matcher.match(term) == types
+
+
+def test_unknown_terms_are_left_to_the_llm(matcher):
+    assert matcher.match("romantic evening") is None
+    assert matcher.match("car") is None
+    assert matcher.stats()["misses"] == 2
+
+
+@pytest.mark.parametrize("term", ["barn", "bart", "spam"])
+def test_short_words_only_match_exactly(matcher, term):
+    assert matcher.match(term) is None
+
+
+def test_hit_rate(matcher):
+    matcher.match("zoo")
+    matcher.match("museums")
+    matcher.match("something obscure")
+    assert matcher.stats()["hit_rate"] == pytest.approx(2 / 3)
+
+
+def test_normalize():
+    assert normalize("  Electronics_Stores! ") == "electronic store"
+    assert normalize("Bus") == "bus"
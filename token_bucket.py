@@ -0,0 +1,123 @@
+# Token bucket rate limiter. Callers reserve a token and are told how
+# long to wait for it, so calls over the limit queue up (in order)
+# instead of failing, and the same bucket works for threads (sleep) and
+# coroutines (asyncio.sleep). KeyedTokenBuckets keeps a separate limit
+# per key.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """
+    Parameters:
+    - rate: Tokens added per second.
+    - capacity: Most tokens that can accumulate, i.e. the largest burst.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waits = 0
+        self.rejected = 0
+
+    def reserve(self, max_wait=None):
+        """
+        Takes a token and returns the seconds to wait before using it
+        (0 if one is available now), or None without taking one if the
+        wait would be longer than max_wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            # Tokens below zero are owed to callers already waiting
+            wait = (1 - self._tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                self.rejected += 1
+                return None
+            self._tokens -= 1
+            self.waits += 1
+            return wait
+
+    def acquire(self, max_wait=None):
+        """
+        Blocks until a token is available. Returns False if that would
+        take longer than max_wait seconds.
+        """
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+    def stats(self):
+        return {"waits": self.waits, "rejected": self.rejected}
+
+
+class KeyedTokenBuckets:
+    """
+    One TokenBucket per key (e.g. per user), for limits that apply to
+    each key separately. The least recently used buckets are dropped
+    beyond maxsize; an idle bucket is full anyway, so that only forgets
+    the recent calls of the least active keys.
+
+    Parameters:
+    - rate, capacity: As for TokenBucket, per key.
+    - maxsize: Most buckets kept.
+    """
+
+    def __init__(self, rate, capacity, maxsize=4096):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.waits = 0
+        self.rejected = 0
+
+    def bucket(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def reserve(self, key, max_wait=None):
+        """
+        TokenBucket.reserve on key's bucket.
+        """
+        wait = self.bucket(key).reserve(max_wait)
+        with self._lock:
+            if wait is None:
+                self.rejected += 1
+            elif wait:
+                self.waits += 1
+        return wait
+
+    def acquire(self, key, max_wait=None):
+        """
+        TokenBucket.acquire on key's bucket.
+        """
+        wait = self.reserve(key, max_wait)
+        if wait is None:
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"keys": len(self._buckets), "waits": self.waits, "rejected": self.rejected}
@@ -0,0 +1,216 @@
+# Local matcher from preference terms to Google Places types.
+#
+# Most inputs to /api/public/preferences_to_types are just a type name
+# in plain English ("zoo", "bars", "art galleries", "cafés"), so
+# they're resolved here in microseconds and only the remaining terms are
+# sent to the LLM (see llm.match_to_places_api_types).
+#
+# Terms are normalized (case, accents, punctuation, plurals) and looked
+# up in an index built from the type names plus a table of synonyms.
+# Anything else is fuzzy matched against the index and accepted above a
+# similarity threshold (config.type_match_threshold).
+
+import difflib
+import re
+import threading
+import unicodedata
+
+# Common words for a type that aren't just its name. Keys are in
+# normalized (singular) form.
+SYNONYMS = {
+    "coffee": ["cafe"],
+    "coffee shop": ["cafe"],
+    "espresso": ["cafe"],
+    "pub": ["bar"],
+    "brewery": ["bar"],
+    "cocktail": ["bar"],
+    "drink": ["bar"],
+    "nightlife": ["night_club", "bar"],
+    "club": ["night_club"],
+    "nightclub": ["night_club"],
+    "dancing": ["night_club"],
+    "art": ["art_gallery", "museum"],
+    "gallery": ["art_gallery"],
+    "history": ["museum"],
+    "food": ["restaurant"],
+    "dining": ["restaurant"],
+    "dinner": ["restaurant"],
+    "lunch": ["restaurant"],
+    "breakfast": ["cafe", "bakery"],
+    "brunch": ["cafe", "restaurant"],
+    "pastry": ["bakery"],
+    "dessert": ["bakery"],
+    "cookie": ["bakery"],
+    "hotel": ["lodging"],
+    "motel": ["lodging"],
+    "hostel": ["lodging"],
+    "shopping": ["shopping_mall", "store"],
+    "mall": ["shopping_mall"],
+    "shop": ["store"],
+    "book": ["book_store", "library"],
+    "bookstore": ["book_store"],
+    "clothes": ["clothing_store"],
+    "fashion": ["clothing_store"],
+    "shoe": ["shoe_store"],
+    "jewelry": ["jewelry_store"],
+    "jewellery": ["jewelry_store"],
+    "nature": ["park"],
+    "hiking": ["park"],
+    "outdoor": ["park"],
+    "outdoors": ["park"],
+    "garden": ["park"],
+    "picnic": ["park"],
+    "camping": ["campground"],
+    "animal": ["zoo"],
+    "wildlife": ["zoo"],
+    "fish": ["aquarium"],
+    "sea life": ["aquarium"],
+    "theme park": ["amusement_park"],
+    "roller coaster": ["amusement_park"],
+    "ride": ["amusement_park"],
+    "movie": ["movie_theater"],
+    "cinema": ["movie_theater"],
+    "film": ["movie_theater"],
+    "theater": ["movie_theater"],
+    "theatre": ["movie_theater"],
+    "sport": ["stadium"],
+    "sports": ["stadium"],
+    "game": ["stadium"],
+    "concert": ["stadium"],
+    "bowling": ["bowling_alley"],
+    "fitness": ["gym"],
+    "workout": ["gym"],
+    "exercise": ["gym"],
+    "massage": ["spa"],
+    "relaxation": ["spa"],
+    "wellness": ["spa"],
+    "gambling": ["casino"],
+    "sightseeing": ["tourist_attraction"],
+    "landmark": ["tourist_attraction"],
+    "attraction": ["tourist_attraction"],
+    "monument": ["tourist_attraction"],
+    "temple": ["hindu_temple"],
+    "cathedral": ["church"],
+    "chapel": ["church"],
+    "religion": ["church", "mosque", "synagogue", "hindu_temple"],
+    "worship": ["church", "mosque", "synagogue", "hindu_temple"],
+    "wine": ["liquor_store", "bar"],
+    "grocery": ["supermarket"],
+    "groceries": ["supermarket"],
+    "market": ["supermarket"],
+    "flower": ["florist"],
+    "pet": ["pet_store"],
+    "beauty": ["beauty_salon"],
+    "salon": ["beauty_salon", "hair_care"],
+    "haircut": ["hair_care"],
+    "barber": ["hair_care"],
+    "takeout": ["meal_takeaway"],
+    "take out": ["meal_takeaway"],
+    "delivery": ["meal_delivery"],
+    "train": ["train_station"],
+    "subway": ["subway_station"],
+    "metro": ["subway_station"],
+    "bus": ["bus_station"],
+    "taxi": ["taxi_stand"],
+    "car hire": ["car_rental"],
+    "medicine": ["pharmacy"],
+    "college": ["university"],
+    "campus": ["university"],
+}
+
+# Terms shorter than this only match exactly
+MIN_FUZZY_LENGTH = 5
+
+_PUNCTUATION = re.compile(r"[^a-z0-9 ]+")
+_SPACES = re.compile(r"\s+")
+
+
+def singular(word, ies="y"):
+    """
+    Crude English singular, good enough for the type names. "-ies" is
+    ambiguous ("galleries", but "movies"); pass ies="ie" for the other
+    reading.
+    """
+    if len(word) <= 3 or word.endswith(("ss", "us", "is")):
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + ies
+    if word.endswith(("ches", "shes", "xes", "sses")):
+        return word[:-2]
+    if word.endswith("s"):
+        return word[:-1]
+    return word
+
+
+def normalize(term, ies="y"):
+    """
+    Lowercases, strips accents and punctuation, and singularizes each
+    word: "Art Galleries" -> "art gallery", "Cafés" -> "cafe".
+    """
+    term = unicodedata.normalize("NFKD", str(term))
+    term = "".join(c for c in term if not unicodedata.combining(c)).lower()
+    term = _PUNCTUATION.sub(" ", term.replace("_", " ").replace("&", " and "))
+    return " ".join(singular(word, ies) for word in _SPACES.sub(" ", term).split())
+
+
+class TypeMatcher:
+    """
+    Resolves preference terms to Places types without the LLM.
+
+    Parameters:
+    - types: The valid Places types (llm.places_api_types).
+    - threshold: Minimum difflib similarity (0-1) for a fuzzy match.
+    """
+
+    def __init__(self, types, threshold=0.88):
+        self.threshold = threshold
+        self.index = {}
+        for place_type in types:
+            self.index[normalize(place_type)] = [place_type]
+            # "night club" -> also "nightclub", "movie theater" -> "movietheater"
+            self.index.setdefault(normalize(place_type).replace(" ", ""), [place_type])
+        valid = set(types)
+        for synonym, synonym_types in SYNONYMS.items():
+            synonym_types = [t for t in synonym_types if t in valid]
+            if synonym_types:
+                self.index.setdefault(normalize(synonym), synonym_types)
+        self._keys = list(self.index)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+
+    def match(self, term):
+        """
+        Returns the list of types for term, or None if there's no
+        confident local match.
+        """
+        key = normalize(term)
+        types = self.index.get(key)
+        if types is None:
+            # "movies" -> "movie", not "movy"
+            types = self.index.get(normalize(term, ies="ie"))
+        fuzzy = False
+        # Short words are too close to other short words ("barn",
+        # "bart" -> "bar", "spam" -> "spa") to fuzzy match safely
+        if types is None and len(key) >= MIN_FUZZY_LENGTH:
+            close = difflib.get_close_matches(key, self._keys, n=1, cutoff=self.threshold)
+            if close:
+                types = self.index[close[0]]
+                fuzzy = True
+        with self._lock:
+            if types is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.fuzzy_hits += fuzzy
+        return list(types) if types is not None else None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "fuzzy_hits": self.fuzzy_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }